@@ -1 +1,2 @@
 from .ppo import PPO
+from .slam_learner import SLAMLearner, compute_slam_loss
@@ -0,0 +1,168 @@
+import copy
+import threading
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def compute_slam_loss(nslam_module, sample, args):
+    """
+    Computes the Neural SLAM training loss on a batch sampled from the
+    SLAM memory. Returns the loss and the weighted loss values of the
+    (proj, exp, pose) terms, None for terms with a zero coefficient.
+    """
+    inputs, outputs = sample
+    b_obs_last, b_obs, b_poses = inputs
+    gt_fp_projs, gt_fp_explored, gt_pose_err = outputs
+
+    b_proj_pred, b_fp_exp_pred, _, _, b_pose_err_pred, _ = \
+        nslam_module(b_obs_last, b_obs, b_poses,
+                     None, None, None,
+                     build_maps=False)
+
+    loss = 0
+    costs = [None, None, None]
+    if args.proj_loss_coeff > 0:
+        proj_loss = F.binary_cross_entropy(b_proj_pred, gt_fp_projs)
+        costs[0] = proj_loss.item()
+        loss += args.proj_loss_coeff * proj_loss
+
+    if args.exp_loss_coeff > 0:
+        exp_loss = F.binary_cross_entropy(b_fp_exp_pred, gt_fp_explored)
+        costs[1] = exp_loss.item()
+        loss += args.exp_loss_coeff * exp_loss
+
+    if args.pose_loss_coeff > 0:
+        pose_loss = nn.MSELoss()(b_pose_err_pred, gt_pose_err)
+        costs[2] = args.pose_loss_coeff * pose_loss.item()
+        loss += args.pose_loss_coeff * pose_loss
+
+    return loss, costs
+
+
+class SLAMLearner():
+    """
+    Trains a copy of the Neural SLAM Module on a background thread from
+    the shared SLAM memory, while the main loop keeps stepping the envs
+    with the actor copy used for map building.
+
+    The learner runs at most `updates_per_step` updates per env step
+    reported with `env_step()`. Every `publish_interval` updates it
+    publishes a snapshot of its weights, which `sync()` loads into the
+    actor module on the main thread. `state_dicts()` returns the current
+    weights and optimizer state, e.g. for checkpoints.
+    """
+
+    def __init__(self, nslam_module, optimizer_fn, memory, args, device,
+                 loss_logs, updates_per_step, publish_interval,
+                 prefetcher=None):
+        self.module = copy.deepcopy(nslam_module)
+        self.module.train()
+        self.optimizer = optimizer_fn(self.module.parameters())
+        self.memory = memory
+        self.prefetcher = prefetcher
+        self.args = args
+        self.device = device
+        self.loss_logs = loss_logs
+        self.updates_per_step = updates_per_step
+        self.publish_interval = publish_interval
+
+        self.num_env_steps = 0
+        self.num_updates = 0
+        self.num_requested = 0
+        self.published = None
+        self.error = None
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.lock = threading.Lock()
+        # Held during an update, so that states are taken between updates
+        self.update_lock = threading.Lock()
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _can_update(self):
+        return self.num_updates < self.num_env_steps * \
+            self.updates_per_step and \
+            len(self.memory) > self.args.slam_batch_size
+
+    def _sample(self):
+        if self.prefetcher is not None:
+            # Keep at least publish_interval batches requested ahead
+            if self.num_requested - self.prefetcher.num_batches < \
+                    self.publish_interval:
+                self.prefetcher.request(self.publish_interval)
+                self.num_requested += self.publish_interval
+            return self.prefetcher.get()
+        return self.memory.sample(self.args.slam_batch_size, self.device)
+
+    def _run(self):
+        try:
+            while True:
+                with self.condition:
+                    while not self.stopped and not self._can_update():
+                        self.condition.wait()
+                    if self.stopped:
+                        return
+
+                sample = self._sample()
+                with self.update_lock, torch.enable_grad():
+                    loss, costs = compute_slam_loss(self.module, sample,
+                                                    self.args)
+                    self.optimizer.zero_grad()
+                    loss.backward()
+                    self.optimizer.step()
+                del sample
+
+                for log, cost in zip(self.loss_logs, costs):
+                    if cost is not None:
+                        log.append(cost)
+
+                self.num_updates += 1
+                if self.num_updates % self.publish_interval == 0:
+                    self._publish()
+        except Exception as e:
+            self.error = e
+
+    def _publish(self):
+        state_dict = {k: v.detach().clone()
+                      for k, v in self.module.state_dict().items()}
+        with self.lock:
+            self.published = state_dict
+
+    def env_step(self, num_steps=1):
+        """Allows the learner updates for num_steps more env steps."""
+        if self.error is not None:
+            raise self.error
+        with self.condition:
+            self.num_env_steps += num_steps
+            self.condition.notify()
+
+    def sync(self, nslam_module):
+        """Loads the last published weights into the actor module."""
+        with self.lock:
+            state_dict, self.published = self.published, None
+        if state_dict is not None:
+            nslam_module.load_state_dict(state_dict)
+        return state_dict is not None
+
+    def state_dicts(self):
+        """Returns copies of the module and optimizer states of the
+        learner."""
+        with self.update_lock:
+            state_dict = {k: v.detach().clone()
+                          for k, v in self.module.state_dict().items()}
+            optimizer_state_dict = copy.deepcopy(self.optimizer.state_dict())
+        return state_dict, optimizer_state_dict
+
+    def load_optimizer_state_dict(self, state_dict):
+        """Restores the optimizer state of the learner."""
+        with self.update_lock:
+            self.optimizer.load_state_dict(state_dict)
+
+    def close(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
@@ -0,0 +1,63 @@
+import argparse
+import time
+from collections import deque
+
+import torch
+import torch.nn as nn
+
+from algo.slam_learner import SLAMLearner
+from utils.storage import FIFOMemory
+
+
+class _ToySLAM(nn.Module):
+    # Same outputs as Neural_SLAM_Module with build_maps=False
+    def __init__(self):
+        super(_ToySLAM, self).__init__()
+        self.proj = nn.Linear(4, 4)
+        self.pose = nn.Linear(4, 3)
+
+    def forward(self, obs_last, obs, poses, maps, explored, current_poses,
+                build_maps=True):
+        x = obs.view(obs.shape[0], -1)
+        pred = torch.sigmoid(self.proj(x)).view(-1, 1, 2, 2)
+        return pred, pred, None, None, self.pose(x), None
+
+
+def _make_learner(module):
+    args = argparse.Namespace(slam_batch_size=4, proj_loss_coeff=1.,
+                              exp_loss_coeff=1., pose_loss_coeff=1.)
+    memory = FIFOMemory(32)
+    for _ in range(16):
+        memory.push((torch.rand(4), torch.rand(4), torch.rand(3)),
+                    ((torch.rand(1, 2, 2) > 0.5).float(),
+                     (torch.rand(1, 2, 2) > 0.5).float(), torch.rand(3)))
+    return SLAMLearner(module, lambda params: torch.optim.Adam(params, 1e-3),
+                       memory, args, 'cpu', (deque(), deque(), deque()),
+                       updates_per_step=2, publish_interval=2)
+
+
+def test_learner_state_dicts_restore():
+    torch.manual_seed(0)
+    module = _ToySLAM()
+    learner = _make_learner(module)
+    learner.env_step(2)
+    start = time.time()
+    while learner.num_updates < 4 and time.time() - start < 30:
+        time.sleep(0.01)
+    state_dict, optimizer_state_dict = learner.state_dicts()
+    learner.close()
+    assert learner.error is None and learner.num_updates == 4
+    assert optimizer_state_dict['state']
+
+    # A learner restored from the states continues from them
+    restored_module = _ToySLAM()
+    restored_module.load_state_dict(state_dict)
+    restored = _make_learner(restored_module)
+    restored.load_optimizer_state_dict(optimizer_state_dict)
+    restored_state, restored_optimizer = restored.state_dicts()
+    restored.close()
+    for k, v in state_dict.items():
+        assert torch.equal(restored_state[k], v)
+    for k, v in optimizer_state_dict['state'][0].items():
+        assert torch.equal(torch.as_tensor(restored_optimizer['state'][0][k]),
+                           torch.as_tensor(v))
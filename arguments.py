@@ -61,6 +61,10 @@ def get_args():
     parser.add_argument('--print_images', type=int, default=0,
                         help='1: save visualization as images')
     parser.add_argument('--save_trajectory_data', type=str, default="0")
+    parser.add_argument('--gt_map_cache_dir', type=str, default="0",
+                        help="""directory to cache the sampled navigable
+                                points per scene, 0 to not cache on disk
+                                (default: 0)""")
 
     # Environment, dataset and episode specifications
     parser.add_argument('-efw', '--env_frame_width', type=int, default=256,
@@ -105,6 +109,11 @@ def get_args():
                         help='use generalized advantage estimation')
     parser.add_argument('--tau', type=float, default=0.95,
                         help='gae parameter (default: 0.95)')
+    parser.add_argument('--vectorized_returns', type=int, default=0,
+                        help="""1: compute the returns of all steps at once
+                                instead of step by step, equal up to
+                                summation order. Faster on GPU
+                                (default: 0)""")
     parser.add_argument('--entropy_coef', type=float, default=0.001,
                         help='entropy term coefficient (default: 0.01)')
     parser.add_argument('--value_loss_coef', type=float, default=0.5,
@@ -138,6 +147,21 @@ def get_args():
                         help='use a recurrent local policy')
     parser.add_argument('--use_deterministic_local', type=int, default=0,
                         help="use classical deterministic local policy")
+    parser.add_argument('--planner_cache', type=int, default=1,
+                        help="""1: reuse the short-term goal planner of the
+                                previous step when its goal and map window
+                                are unchanged, same goals as 0 (default: 1)""")
+    parser.add_argument('--bounded_gt_planner', type=int, default=1,
+                        help="""1: compute ground-truth local policy actions
+                                skipping goal radii which cannot reach the
+                                agent, same actions as 0 (default: 1)
+                                0: solve every goal radius""")
+    parser.add_argument('--gt_planner_max_solves', type=int, default=0,
+                        help="""maximum number of FMM solves per ground-truth
+                                action with --bounded_gt_planner 1, actions
+                                head straight to the goal when exceeded,
+                                0: no limit, up to 56 solves per action
+                                when the goal is unreachable (default: 0)""")
 
     # Neural SLAM Module
     parser.add_argument('-pe', '--use_pose_estimation', type=int, default=2)
@@ -148,11 +172,48 @@ def get_args():
     parser.add_argument('-sbs', '--slam_batch_size', type=int, default=72)
     parser.add_argument('-sit', '--slam_iterations', type=int, default=10)
     parser.add_argument('-sms', '--slam_memory_size', type=int, default=500000)
+    parser.add_argument('--compact_slam_memory', type=int, default=1,
+                        help="""1: store SLAM datapoints with shared uint8
+                                frames and bit-packed projections,
+                                0: store every field separately (default: 1)""")
+    parser.add_argument('--slam_memory_path', type=str, default="0",
+                        help="""file to memory-map the SLAM replay memory
+                                to, resumed if it exists, 0 to keep it in
+                                RAM (default: 0)""")
+    parser.add_argument('--slam_prefetch', type=int, default=0,
+                        help="""number of SLAM training batches sampled
+                                ahead on a background thread, 0 to sample
+                                them synchronously (default: 0)""")
+    parser.add_argument('--async_slam', type=int, default=0,
+                        help="""1: train the SLAM module on a background
+                                thread, running up to slam_iterations updates
+                                per env step, instead of after every env step
+                                (default: 0)""")
+    parser.add_argument('--slam_publish_interval', type=int, default=10,
+                        help="""number of asynchronous SLAM updates between
+                                weight updates of the module used for map
+                                building (default: 10)""")
     parser.add_argument('--proj_loss_coeff', type=float, default=1.0)
     parser.add_argument('--pose_loss_coeff', type=float, default=10000.0)
     parser.add_argument('--exp_loss_coeff', type=float, default=1.0)
     parser.add_argument('--global_downscaling', type=int, default=2)
     parser.add_argument('--map_pred_threshold', type=float, default=0.5)
+    parser.add_argument('--slam_pred_cache', type=int, default=1,
+                        help="""reuse the egocentric prediction of the
+                                previous step for the last obs when building
+                                maps. 0: never, 1: when the SLAM module is in
+                                eval mode (exact), 2: also when training it,
+                                with dropout masks and weights of the previous
+                                step (default: 1)""")
+    parser.add_argument('--fused_warp', type=int, default=0,
+                        help="""1: rotate and translate maps with a single
+                                grid_sample, which interpolates once instead
+                                of twice (default: 0)""")
+    parser.add_argument('--windowed_aggregation', type=int, default=0,
+                        help="""1: warp the egocentric prediction only in a
+                                window around the agent and merge it in place
+                                into the local map, uses the fused warp
+                                (default: 0)""")
 
     parser.add_argument('--vision_range', type=int, default=64)
     parser.add_argument('--obstacle_boundary', type=int, default=5)
@@ -162,6 +223,21 @@ def get_args():
     parser.add_argument('-ot', '--obs_threshold', type=float, default=1)
     parser.add_argument('-ct', '--collision_threshold', type=float, default=0.20)
     parser.add_argument('-nl', '--noise_level', type=float, default=1.0)
+    parser.add_argument('--incremental_mapping', type=int, default=1,
+                        help="""1: update the ground-truth map only inside
+                                the window touched by each frame (default: 1)
+                                0: rebuild the full map every step""")
+
+    parser.add_argument('--shared_memory_obs', type=int, default=0,
+                        help="""1: pass observations and maps from the env
+                                workers through shared memory (default: 0)""")
+    parser.add_argument('--shared_memory_slots', type=int, default=2,
+                        help="""number of slots per env in the shared
+                                memory ring buffer (default: 2)""")
+    parser.add_argument('--async_planner', type=int, default=1,
+                        help="""1: let the env workers plan the short-term
+                                goals while the trainer runs the training
+                                updates of the step (default: 1)""")
 
     # parse arguments
     args = parser.parse_args()
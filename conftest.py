@@ -0,0 +1,6 @@
+import importlib.util
+
+# The habitat envs can only be imported with habitat installed
+collect_ignore = []
+if importlib.util.find_spec("habitat") is None:
+    collect_ignore.append("env/habitat")
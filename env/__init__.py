@@ -1,44 +1,84 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
-import habitat
-from .habitat import construct_envs_generator
 
 
 def gen_vec_envs(args):
+    # Imported here so that the env utils can be used without habitat
+    from .habitat import construct_envs_generator
+
     envs_gen = construct_envs_generator(args)
-    for envs in envs_gen:
-        envs = VecPyTorch(envs, args.device)
+    for envs, shared_buffer in envs_gen:
+        envs = VecPyTorch(envs, args.device, shared_buffer)
         yield envs
 
 
 # Adapted from https://github.com/ikostrikov/pytorch-a2c-ppo-acktr-gail/blob/master/a2c_ppo_acktr/envs.py#L159
 class VecPyTorch():
 
-    def __init__(self, venv, device):
+    # Info entries which are static for an episode, envs only send them
+    # on reset and they are merged into the infos of every step
+    static_info_keys = ['explorable_map']
+
+    def __init__(self, venv, device, shared_buffer=None):
         self.venv = venv
         self.num_envs = venv.num_envs
         self.observation_space = venv.observation_space
         self.action_space = venv.action_space
         self.device = device
+        self.shared_buffer = shared_buffer
+        self.static_info = [{} for _ in range(self.num_envs)]
+        self.planner_executor = None
+        self.planner_future = None
+
+    def _merge_static_info(self, info):
+        for e, env_info in enumerate(info):
+            for key in self.static_info_keys:
+                if key in env_info:
+                    self.static_info[e][key] = env_info[key]
+            env_info.update(self.static_info[e])
+
+    def _get_obs(self, obs, info):
+        if self.shared_buffer is None:
+            return torch.from_numpy(obs).float()
+
+        # obs holds the slots written by each env in the shared buffer,
+        # maps in info are numpy views valid until the env's next step
+        slots = [env_info['shared_slot'] for env_info in info]
+        for e, env_info in enumerate(info):
+            for name in ['explored_map', 'fp_proj', 'fp_explored']:
+                env_info[name] = self.shared_buffer.view(name, e, slots[e])
+        return self.shared_buffer.read('obs', slots).float()
+
+    def _assert_no_planner_request(self):
+        assert self.planner_future is None, \
+            "get_short_term_goal_wait must be called before using the envs"
 
     def reset(self):
+        self._assert_no_planner_request()
         obs, info = self.venv.reset()
-        obs = torch.from_numpy(obs).float()
+        self._merge_static_info(info)
+        obs = self._get_obs(obs, info)
         return obs, info
 
     def step_async(self, actions):
+        self._assert_no_planner_request()
         actions = actions.cpu().numpy()
         self.venv.step_async(actions)
 
     def step_wait(self):
         obs, reward, done, info = self.venv.step_wait()
-        obs = torch.from_numpy(obs).float()
+        self._merge_static_info(info)
+        obs = self._get_obs(obs, info)
         reward = torch.from_numpy(reward).float()
         return obs, reward, done, info
 
     def step(self, actions):
+        self._assert_no_planner_request()
         actions = actions.cpu().numpy()
         obs, reward, done, info = self.venv.step(actions)
-        obs = torch.from_numpy(obs).float()
+        self._merge_static_info(info)
+        obs = self._get_obs(obs, info)
         reward = torch.from_numpy(reward).float()
         return obs, reward, done, info
 
@@ -48,9 +88,37 @@ class VecPyTorch():
         return reward
 
     def get_short_term_goal(self, inputs):
+        self._assert_no_planner_request()
         stg = self.venv.get_short_term_goal(inputs)
         stg = torch.from_numpy(stg).float()
         return stg
 
+    def get_short_term_goal_async(self, inputs, wait=None):
+        """
+        Sends the planner inputs to the envs from a background thread and
+        returns immediately. The envs plan while the caller keeps working,
+        the short-term goals are collected with get_short_term_goal_wait.
+        wait is called on the background thread before the inputs are
+        sent, e.g. to wait for asynchronous copies into the inputs.
+        """
+        self._assert_no_planner_request()
+        if self.planner_executor is None:
+            self.planner_executor = ThreadPoolExecutor(max_workers=1)
+        self.planner_future = self.planner_executor.submit(
+            self._get_short_term_goal_after, inputs, wait)
+
+    def _get_short_term_goal_after(self, inputs, wait):
+        if wait is not None:
+            wait()
+        return self.venv.get_short_term_goal(inputs)
+
+    def get_short_term_goal_wait(self):
+        stg = self.planner_future.result()
+        self.planner_future = None
+        stg = torch.from_numpy(stg).float()
+        return stg
+
     def close(self):
+        if self.planner_executor is not None:
+            self.planner_executor.shutdown()
         return self.venv.close()
@@ -7,11 +7,12 @@ from habitat.config.default import get_config as cfg_env
 from habitat.datasets.pointnav.pointnav_dataset import PointNavDatasetV1
 
 from .exploration_env import Exploration_Env
+from env.utils.shared_buffer import get_shared_buffer
 from .habitat_api.habitat.core.vector_env import VectorEnv
 from .habitat_api.habitat_baselines.config.default import get_config as cfg_baseline
 
 
-def make_env_fn(args, config_env, config_baseline, rank):
+def make_env_fn(args, config_env, config_baseline, rank, shared_buffer=None):
     dataset = PointNavDatasetV1(config_env.DATASET)
     config_env.defrost()
     config_env.SIMULATOR.SCENE = dataset.episodes[0].scene_id
@@ -19,7 +20,8 @@ def make_env_fn(args, config_env, config_baseline, rank):
     config_env.freeze()
 
     env = Exploration_Env(args=args, rank=rank,
-                          config_env=config_env, config_baseline=config_baseline, dataset=dataset
+                          config_env=config_env, config_baseline=config_baseline, dataset=dataset,
+                          shared_buffer=shared_buffer
                           )
 
     env.seed(rank)
@@ -95,17 +97,24 @@ def construct_envs_generator(args):
             baseline_configs.append(config_baseline)
             env_configs.append(config_env)
 
+        # Observations and maps are passed through shared memory,
+        # only slot indices go through the pipes
+        shared_buffer = None
+        if args.shared_memory_obs:
+            shared_buffer = get_shared_buffer(args, len(args_list))
+
         # if (len(env_configs)) % args.num_processes == 0:
         envs = VectorEnv(
             make_env_fn=make_env_fn,
             env_fn_args=tuple(
                 tuple(
                     zip(args_list, env_configs, baseline_configs,
-                        range(len(args_list)))
+                        range(len(args_list)),
+                        [shared_buffer] * len(args_list))
                 )
             ),
         )
-        yield envs
+        yield envs, shared_buffer
         env_configs = []
         baseline_configs = []
         args_list = []
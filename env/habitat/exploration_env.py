@@ -1,8 +1,10 @@
+import collections
 import math
 import os
 import pickle
 import sys
 
+import cv2
 import gym
 import matplotlib
 import numpy as np
@@ -28,9 +30,9 @@ from env.utils.fmm_planner import FMMPlanner
 from env.habitat.utils.noisy_actions import CustomActionSpaceConfiguration
 from env.habitat.utils import pose as pu
 from env.habitat.utils import visualizations as vu
-from env.habitat.utils.supervision import HabitatMaps
+from env.habitat.utils.supervision import HabitatMaps, get_scene_key
 
-from model import get_grid
+from model import get_grid, warp_affine
 
 
 def _preprocess_depth(depth):
@@ -49,7 +51,8 @@ def _preprocess_depth(depth):
 
 class Exploration_Env(habitat.RLEnv):
 
-    def __init__(self, args, rank, config_env, config_baseline, dataset):
+    def __init__(self, args, rank, config_env, config_baseline, dataset,
+                 shared_buffer=None):
         if args.visualize:
             plt.ion()
         if args.print_images or args.visualize:
@@ -97,7 +100,13 @@ class Exploration_Env(habitat.RLEnv):
                     transforms.Resize((args.frame_height, args.frame_width),
                                       interpolation = Image.NEAREST)])
         self.scene_name = None
-        self.maps_dict = {}
+        # Ground-truth maps of recently visited scenes, each one holds the
+        # height index of 1e6 sampled points (about 12MB)
+        self.maps_dict = collections.OrderedDict()
+        self.maps_dict_size = 2
+        self.stg_planner = None
+        self.stg_planner_key = None
+        self.shared_buffer = shared_buffer
 
     def randomize_env(self):
         self._env._episode_iterator._shuffle_iterator()
@@ -177,6 +186,8 @@ class Exploration_Env(habitat.RLEnv):
         self.visited_gt = np.zeros(self.map.shape)
         self.collison_map = np.zeros(self.map.shape)
         self.col_width = 1
+        self.stg_planner = None
+        self.stg_planner_key = None
 
         # Set info
         self.info = {
@@ -191,6 +202,9 @@ class Exploration_Env(habitat.RLEnv):
 
         self.save_position()
 
+        if self.shared_buffer is not None:
+            state = self._write_shared_buffer(state)
+
         return state, self.info
 
     def step(self, action):
@@ -290,8 +304,10 @@ class Exploration_Env(habitat.RLEnv):
         self.info['pose_err'] = [dx_gt - dx_base,
                                  dy_gt - dy_base,
                                  do_gt - do_base]
-        self.info['explored_map'] = self.explored_map,
-        self.info['explorable_map'] = self.explorable_map
+        self.info['explored_map'] = self.explored_map
+        # The explorable map is static for the episode, it is only sent
+        # in the reset info and cached by VecPyTorch
+        self.info.pop('explorable_map', None)
 
 
         if self.timestep%args.num_local_steps==0:
@@ -311,8 +327,24 @@ class Exploration_Env(habitat.RLEnv):
         else:
             done = False
 
+        if self.shared_buffer is not None:
+            state = self._write_shared_buffer(state)
+
         return state, rew, done, self.info
 
+    def _write_shared_buffer(self, state):
+        # Write the observation and maps to shared memory and only send
+        # the slot index, VecPyTorch reads them back from the buffer
+        slot = self.shared_buffer.write(
+                    self.rank, obs=state,
+                    explored_map=self.info['explored_map'],
+                    fp_proj=self.info['fp_proj'],
+                    fp_explored=self.info['fp_explored'])
+        for name in ['explored_map', 'fp_proj', 'fp_explored']:
+            self.info[name] = None
+        self.info['shared_slot'] = slot
+        return np.array(slot)
+
     def get_reward_range(self):
         # This function is not used, Habitat-RLEnv requires this function
         return (0., 1.0)
@@ -365,6 +397,7 @@ class Exploration_Env(habitat.RLEnv):
         params['vision_range'] = self.args.vision_range
         params['visualize'] = self.args.visualize
         params['obs_threshold'] = self.args.obs_threshold
+        params['incremental'] = self.args.incremental_mapping
         self.selem = skimage.morphology.disk(self.args.obstacle_boundary /
                                              self.args.map_resolution)
         mapper = MapBuilder(params)
@@ -583,17 +616,29 @@ class Exploration_Env(habitat.RLEnv):
 
     def _get_gt_map(self, full_map_size):
         self.scene_name = self.habitat_env.sim.config.SCENE
-        logger.error('Computing map for %s', self.scene_name)
 
-        # Get map in habitat simulator coordinates
-        self.map_obj = HabitatMaps(self.habitat_env)
+        # Get map in habitat simulator coordinates, the sampled points
+        # only depend on the scene so they are reused across episodes
+        if self.scene_name not in self.maps_dict:
+            logger.error('Computing map for %s', self.scene_name)
+            cache_dir = None
+            if self.args.gt_map_cache_dir != "0":
+                cache_dir = self.args.gt_map_cache_dir
+            self.maps_dict[self.scene_name] = HabitatMaps(
+                self.habitat_env, cache_dir=cache_dir,
+                scene_key=get_scene_key(self.scene_name))
+            if len(self.maps_dict) > self.maps_dict_size:
+                self.maps_dict.popitem(last=False)
+        self.maps_dict.move_to_end(self.scene_name)
+        self.map_obj = self.maps_dict[self.scene_name]
         if self.map_obj.size[0] < 1 or self.map_obj.size[1] < 1:
             logger.error("Invalid map: {}/{}".format(
                             self.scene_name, self.episode_no))
+            del self.maps_dict[self.scene_name]
             return None
 
         agent_y = self._env.sim.get_agent_state().position.tolist()[1]*100.
-        sim_map = self.map_obj.get_map(agent_y, -50., 50.0)
+        sim_map = self.map_obj.get_map(agent_y, -50., 50.0).copy()
 
         sim_map[sim_map > 0] = 1.
 
@@ -629,23 +674,35 @@ class Exploration_Env(habitat.RLEnv):
                     180.0 + np.rad2deg(o)
                 ]])
 
-        rot_mat, trans_mat = get_grid(st, (1, 1,
-            grid_size, grid_size), torch.device("cpu"))
-
         grid_map = torch.from_numpy(grid_map).float()
         grid_map = grid_map.unsqueeze(0).unsqueeze(0)
-        # translated = F.grid_sample(grid_map, trans_mat, align_corners=True)
-        # rotated = F.grid_sample(translated, rot_mat, align_corners=True)
-        translated = F.grid_sample(grid_map, trans_mat)
-        rotated = F.grid_sample(translated, rot_mat)
+        if self.args.fused_warp:
+            rotated = None
+        else:
+            rot_mat, trans_mat = get_grid(st, (1, 1,
+                grid_size, grid_size), torch.device("cpu"))
+
+            # translated = F.grid_sample(grid_map, trans_mat, align_corners=True)
+            # rotated = F.grid_sample(translated, rot_mat, align_corners=True)
+            translated = F.grid_sample(grid_map, trans_mat)
+            rotated = F.grid_sample(translated, rot_mat)
 
         episode_map = torch.zeros((full_map_size, full_map_size)).float()
         if full_map_size > grid_size:
+            if rotated is None:
+                rotated = warp_affine(grid_map, st, rotate_first=False)
             episode_map[(full_map_size - grid_size)//2:
                         (full_map_size - grid_size)//2 + grid_size,
                         (full_map_size - grid_size)//2:
                         (full_map_size - grid_size)//2 + grid_size] = \
                                 rotated[0,0]
+        elif rotated is None:
+            # Only warp the center window kept in the episode map
+            start = (grid_size - full_map_size)//2
+            episode_map = warp_affine(grid_map, st, rotate_first=False,
+                                      window=(start, start + full_map_size,
+                                              start, start + full_map_size)
+                                      )[0,0]
         else:
             episode_map = rotated[0,0,
                               (grid_size - full_map_size)//2:
@@ -721,9 +778,8 @@ class Exploration_Env(habitat.RLEnv):
 
         traversible = add_boundary(traversible)
 
-        planner = FMMPlanner(traversible, 360//self.dt)
-
-        reachable = planner.set_goal([goal[1]-y1+1, goal[0]-x1+1])
+        planner = self._get_stg_planner(traversible,
+                                        [goal[1]-y1+1, goal[0]-x1+1])
 
         stg_x, stg_y = start[0] - x1 + 1, start[1] - y1 + 1
         for i in range(self.args.short_goal_dist):
@@ -736,8 +792,56 @@ class Exploration_Env(habitat.RLEnv):
         return (stg_x, stg_y)
 
 
+    def _get_stg_planner(self, traversible, goal):
+        """Returns a planner for traversible with its goal set, reusing the
+        previous step's planner when both are unchanged."""
+        key = tuple(goal)
+        if self.args.planner_cache and key == self.stg_planner_key and \
+                np.array_equal(traversible, self.stg_planner.traversible):
+            return self.stg_planner
+
+        planner = FMMPlanner(traversible, 360//self.dt)
+        planner.set_goal(goal)
+
+        if self.args.planner_cache:
+            self.stg_planner = planner
+            self.stg_planner_key = key
+        return planner
+
+
     def _get_gt_action(self, grid, start, goal, planning_window, start_o):
 
+        if self.args.bounded_gt_planner:
+            stg = self._get_gt_stg_bounded(grid, start, goal, planning_window)
+            if stg is None:
+                # Planning budget exhausted, head straight to the goal
+                stg = goal
+        else:
+            stg = self._get_gt_stg(grid, start, goal, planning_window)
+
+        stg_x_gt, stg_y_gt = stg
+        angle_st_goal = math.degrees(math.atan2(stg_x_gt - start[0],
+                                                stg_y_gt - start[1]))
+        angle_agent = (start_o)%360.0
+        if angle_agent > 180:
+            angle_agent -= 360
+
+        relative_angle = (angle_agent - angle_st_goal)%360.0
+        if relative_angle > 180:
+            relative_angle -= 360
+
+        if relative_angle > 15.:
+            gt_action = 1
+        elif relative_angle < -15.:
+            gt_action = 0
+        else:
+            gt_action = 2
+
+        return gt_action
+
+
+    def _get_gt_stg(self, grid, start, goal, planning_window):
+
         [gx1, gx2, gy1, gy2] = planning_window
 
         x1 = min(start[0], goal[0])
@@ -784,21 +888,121 @@ class Exploration_Env(habitat.RLEnv):
                 path_found = True
 
         stg_x_gt, stg_y_gt = stg_x_gt + x1, stg_y_gt + y1
-        angle_st_goal = math.degrees(math.atan2(stg_x_gt - start[0],
-                                                stg_y_gt - start[1]))
-        angle_agent = (start_o)%360.0
-        if angle_agent > 180:
-            angle_agent -= 360
+        return stg_x_gt, stg_y_gt
 
-        relative_angle = (angle_agent - angle_st_goal)%360.0
-        if relative_angle > 180:
-            relative_angle -= 360
 
-        if relative_angle > 15.:
-            gt_action = 1
-        elif relative_angle < -15.:
-            gt_action = 0
-        else:
-            gt_action = 2
+    def _get_gt_stg_bounded(self, grid, start, goal, planning_window):
+        """Same search and result as _get_gt_stg, but goal radii which
+        provably cannot connect the goal to the agent are skipped instead of
+        solved. With gt_planner_max_solves > 0 at most that many FMM solves
+        are run and None is returned when the budget is exhausted."""
 
-        return gt_action
+        [gx1, gx2, gy1, gy2] = planning_window
+        max_solves = self.args.gt_planner_max_solves
+        num_solves = 0
+
+        grid = grid[gx1:gx2, gy1:gy2]
+        visited = self.visited[gx1:gx2, gy1:gy2] == 1
+        selem = self.selem.astype(np.uint8)
+
+        x1 = min(start[0], goal[0])
+        x2 = max(start[0], goal[0])
+        y1 = min(start[1], goal[1])
+        y2 = max(start[1], goal[1])
+        dist = pu.get_l2_distance(goal[0], start[0], goal[1], start[1])
+        buf = max(5., dist)
+        x1 = max(0, int(x1 - buf))
+        x2 = min(grid.shape[0], int(x2 + buf))
+        y1 = max(0, int(y1 - buf))
+        y2 = min(grid.shape[1], int(y2 + buf))
+
+        def get_traversible():
+            traversible = cv2.dilate((grid[x1:x2, y1:y2] != 0).astype(np.uint8),
+                                     selem) == 0
+            traversible[visited[x1:x2, y1:y2]] = 1
+            traversible[int(start[0]-x1)-1:int(start[0]-x1)+2,
+                        int(start[1]-y1)-1:int(start[1]-y1)+2] = 1
+            return traversible
+
+        def add_goal(traversible, goal_r):
+            traversible[int(goal[0]-x1)-goal_r:int(goal[0]-x1)+goal_r+1,
+                        int(goal[1]-y1)-goal_r:int(goal[1]-y1)+goal_r+1] = 1
+            return traversible
+
+        def plan(traversible):
+            planner = FMMPlanner(traversible, 360//self.dt, 1)
+            planner.set_goal([goal[1]-y1, goal[0]-x1])
+            return planner.get_short_term_goal([start[0] - x1,
+                                                start[1] - y1])
+
+        # Grow the planning window
+        while True:
+            if max_solves and num_solves >= max_solves:
+                return None
+            stg_x_gt, stg_y_gt, replan = plan(add_goal(get_traversible(), 0))
+            num_solves += 1
+            if not replan:
+                return stg_x_gt + x1, stg_y_gt + y1
+            if buf >= 100.:
+                break
+            buf = 2*buf
+            x1 = max(0, int(x1 - buf))
+            x2 = min(grid.shape[0], int(x2 + buf))
+            y1 = max(0, int(y1 - buf))
+            y2 = min(grid.shape[1], int(y2 + buf))
+
+        # Grow the goal radius, the window is fixed from here on so the
+        # obstacles are only dilated once
+        traversible = get_traversible()
+        may_connect = self._get_gt_goal_radius_filter(
+            add_goal(traversible.copy(), 0),
+            (int(start[0]-x1), int(start[1]-y1)),
+            (int(goal[0]-x1), int(goal[1]-y1)))
+        for goal_r in range(1, 51):
+            if goal_r < 50 and not may_connect(goal_r):
+                continue
+            if max_solves and num_solves >= max_solves:
+                return None
+            stg_x_gt, stg_y_gt, replan = plan(add_goal(traversible.copy(),
+                                                       goal_r))
+            num_solves += 1
+            if not replan:
+                break
+        return stg_x_gt + x1, stg_y_gt + y1
+
+    def _get_gt_goal_radius_filter(self, traversible, start, goal):
+        """Returns a function telling whether clearing the square of radius
+        goal_r around the goal can stop the planner from replanning.
+
+        The short-term goal only depends on the FMM distances in the
+        (2 * du + 1)^2 patch around the agent. If no cell of the patch is
+        connected to the goal, the patch has the same fill distance
+        everywhere and the planner replans. A patch cell is connected iff
+        it is the goal or lies in the cleared square, or its 4-connected
+        component contains or is next to one of them. Patches crossing
+        the window border are padded by the planner and never skipped.
+        """
+        du = FMMPlanner(traversible, 360//self.dt, 1).du
+        h, w = traversible.shape
+        sx, sy = start
+        if not (du <= sx < h - du and du <= sy < w - du):
+            return lambda goal_r: True
+
+        _, labels = cv2.connectedComponents(traversible.astype(np.uint8),
+                                            connectivity=4)
+        patch = np.zeros((h, w), dtype=bool)
+        patch[sx-du:sx+du+1, sy-du:sy+du+1] = True
+        near = np.isin(labels, np.unique(labels[patch & traversible])) & \
+            traversible
+        cross = np.array([[0, 1, 0], [1, 1, 1], [0, 1, 0]], dtype=np.uint8)
+        target = (cv2.dilate(near.astype(np.uint8), cross) > 0) | patch
+        if target[goal[0], goal[1]]:
+            return lambda goal_r: True
+
+        def may_connect(goal_r):
+            # Same slices as the cleared square, which can wrap around at
+            # the window border
+            return bool(target[goal[0]-goal_r:goal[0]+goal_r+1,
+                               goal[1]-goal_r:goal[1]+goal_r+1].any())
+
+        return may_connect
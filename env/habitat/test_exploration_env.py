@@ -0,0 +1,97 @@
+import types
+
+import numpy as np
+import skimage.morphology
+
+from env.habitat.exploration_env import Exploration_Env
+
+
+def _make_env(max_solves=0, planner_cache=1):
+    env = Exploration_Env.__new__(Exploration_Env)
+    env.args = types.SimpleNamespace(bounded_gt_planner=1,
+                                     gt_planner_max_solves=max_solves,
+                                     planner_cache=planner_cache,
+                                     short_goal_dist=1)
+    env.dt = 10
+    env.selem = skimage.morphology.disk(1)
+    env.stg_planner = None
+    env.stg_planner_key = None
+    return env
+
+
+def _random_case(rng):
+    size = rng.choice([40, 80, 160])
+    grid = (rng.rand(size, size) < rng.choice([0.02, 0.1, 0.2])).astype(float)
+    for _ in range(rng.randint(0, 6)):
+        if rng.rand() < 0.5:
+            grid[rng.randint(size), :] = 1
+        else:
+            grid[:, rng.randint(size)] = 1
+    visited = (rng.rand(size, size) < 0.01).astype(float)
+    x1 = rng.randint(0, size - 4)
+    x2 = rng.randint(x1 + 4, size + 1)
+    y1 = rng.randint(0, size - 4)
+    y2 = rng.randint(y1 + 4, size + 1)
+    start = [rng.randint(0, x2 - x1), rng.randint(0, y2 - y1)]
+    goal = [rng.randint(0, x2 - x1), rng.randint(0, y2 - y1)]
+    return grid, visited, [x1, x2, y1, y2], start, goal
+
+
+def test_bounded_gt_stg_matches_full_search():
+    env = _make_env()
+    rng = np.random.RandomState(0)
+    for _ in range(100):
+        grid, env.visited, window, start, goal = _random_case(rng)
+        assert env._get_gt_stg_bounded(grid, start, goal, window) == \
+            env._get_gt_stg(grid, start, goal, window)
+
+
+def test_bounded_gt_stg_enclosed_goal():
+    # The goal is walled in, so the search has to grow the goal radius
+    env = _make_env()
+    grid = np.zeros((120, 120))
+    grid[50:71, 50] = grid[50:71, 70] = 1
+    grid[50, 50:71] = grid[70, 50:71] = 1
+    env.visited = np.zeros((120, 120))
+    window = [0, 120, 0, 120]
+    start, goal = [20, 25], [60, 60]
+    assert env._get_gt_stg_bounded(grid, start, goal, window) == \
+        env._get_gt_stg(grid, start, goal, window)
+
+
+def test_bounded_gt_stg_max_solves():
+    env = _make_env(max_solves=1)
+    grid = np.zeros((120, 120))
+    grid[50:71, 50] = grid[50:71, 70] = 1
+    grid[50, 50:71] = grid[70, 50:71] = 1
+    env.visited = np.zeros((120, 120))
+    assert env._get_gt_stg_bounded(grid, [20, 25], [60, 60],
+                                   [0, 120, 0, 120]) is None
+
+
+def test_cached_stg_matches_full_solve():
+    cached, full = _make_env(planner_cache=1), _make_env(planner_cache=0)
+    rng = np.random.RandomState(0)
+    grid = (rng.rand(120, 120) < 0.02).astype(float)
+    explored = np.zeros((120, 120))
+    explored[10:110, 10:110] = 1
+    for env in (cached, full):
+        env.collison_map = np.zeros((120, 120))
+        env.visited = np.zeros((120, 120))
+    goal = [90, 80]
+    start = [20, 20]
+    reused = 0
+    for step in range(40):
+        if step % 4 == 3:
+            # Map updates in some steps, the goal changes in others
+            grid[rng.randint(120), rng.randint(120)] = 1
+        if step % 10 == 9:
+            goal = [rng.randint(15, 105), rng.randint(15, 105)]
+        last = cached.stg_planner
+        stg = cached._get_stg(grid, explored, list(start), list(goal),
+                              [0, 120, 0, 120])
+        reused += last is not None and cached.stg_planner is last
+        assert stg == full._get_stg(grid, explored, list(start), list(goal),
+                                    [0, 120, 0, 120])
+        start = [int(stg[0]), int(stg[1])]
+    assert reused > 0
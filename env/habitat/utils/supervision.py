@@ -1,30 +1,110 @@
+import collections
+import hashlib
+import os
+import tempfile
+
 import numpy as np
 
 
+def get_scene_key(scene):
+    """
+    Returns a file-system friendly key for a scene path. The basename keeps
+    cache folders readable, the hash keeps scenes with the same basename
+    (e.g. replica's mesh_semantic.ply) apart.
+    """
+    name = os.path.splitext(os.path.basename(scene))[0]
+    digest = hashlib.md5(scene.encode('utf-8')).hexdigest()[:8]
+    return "{}_{}".format(name, digest)
+
+
+def _save_npz(path, **arrays):
+    # Write to a temporary file and rename, so that workers sharing a scene
+    # never read a partially written cache file.
+    folder = os.path.dirname(path)
+    if not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _load_npz(path, keys):
+    try:
+        with np.load(path) as data:
+            return [data[key] for key in keys]
+    except (OSError, KeyError, ValueError):
+        return None
+
+
 class HabitatMaps(object):
-    def __init__(self, env, N=int(1e6), resolution=5, padding=0):
+    def __init__(self, env, N=int(1e6), resolution=5, padding=0,
+                 cache_dir=None, scene_key=None):
         # convert to cm
         self.resolution = resolution
         self.padding = padding
 
-        pts = self._sample_points(env, N) * 100.
+        # Sampled points only depend on the scene, they are cached on disk
+        # under cache_dir/scene_key when a cache directory is given.
+        self.cache_dir = None
+        if cache_dir is not None and scene_key is not None:
+            self.cache_dir = os.path.join(cache_dir, scene_key)
+        self.N = N
+        # Recently used band maps, keyed by the exact band
+        self.band_maps = collections.OrderedDict()
+        self.band_maps_size = 4
+
+        pts = self._get_points(env, N)
 
         # Bin points based on x and z values, so that
         # we can quickly pool them based on y-filtering.
-        self.y = pts[:, 1]
+        y = pts[:, 1]
         zx = pts[:, [2, 0]]
         self.origin, self.size, self.max = self._make_map(
             zx, self.padding, self.resolution)
 
         zx = zx - self.origin
-        self.zx = (zx / self.resolution).astype(np.int)
+        zx = (zx / self.resolution).astype(np.int)
+
+        # Index of the points sorted by height with their flattened cell
+        # ids, a height band is then a contiguous slice of the index. Only
+        # the index is kept, not the points.
+        order = np.argsort(y, kind='stable')
+        self.sorted_y = y[order]
+        self.sorted_cells = (zx[order, 1] * self.size[0] +
+                             zx[order, 0]).astype(np.int64)
 
     def get_map(self, y, lb, ub):
-        ids = np.logical_and(self.y > y + lb, self.y < y + ub)
-        num_points = np.zeros((self.size[1], self.size[0]), dtype=np.int32)
-        np.add.at(num_points, (self.zx[ids, 1], self.zx[ids, 0]), 1)
+        """
+        Returns the number of points in each cell with height in
+        (y + lb, y + ub). The maps of recent bands are memoized, the
+        returned array is shared, copy before modifying it.
+        """
+        key = (float(y), float(lb), float(ub))
+        if key in self.band_maps:
+            self.band_maps.move_to_end(key)
+            return self.band_maps[key]
+
+        num_points = self._compute_map(y + lb, y + ub)
+        self.band_maps[key] = num_points
+        if len(self.band_maps) > self.band_maps_size:
+            self.band_maps.popitem(last=False)
         return num_points
 
+    def _compute_map(self, y_min, y_max):
+        # Points with y_min < y < y_max, found by binary search
+        start = np.searchsorted(self.sorted_y, y_min, side='right')
+        end = np.searchsorted(self.sorted_y, y_max, side='left')
+        num_points = np.bincount(self.sorted_cells[start:max(start, end)],
+                                 minlength=self.size[0] * self.size[1])
+        num_points = num_points.astype(np.int32)
+        return num_points.reshape(self.size[1], self.size[0])
+
     def _make_map(self, zx, padding, resolution):
         """Returns a map structure."""
         min_, max_ = self._get_xy_bounding_box(zx, padding=padding)
@@ -38,6 +118,21 @@ class HabitatMaps(object):
         max_ = np.ceil(np.max(zx, axis=0) + padding).astype(np.int)
         return min_, max_
 
+    def _get_points(self, env, N):
+        """Loads the sampled points (in cm) from disk or samples them."""
+        if self.cache_dir is None:
+            return self._sample_points(env, N) * 100.
+
+        path = os.path.join(self.cache_dir, "points_n{}.npz".format(N))
+        if os.path.exists(path):
+            loaded = _load_npz(path, ['pts'])
+            if loaded is not None and loaded[0].shape == (N, 3):
+                return loaded[0]
+
+        pts = self._sample_points(env, N) * 100.
+        _save_npz(path, pts=pts)
+        return pts
+
     def _sample_points(self, env, N):
         pts = np.zeros((N, 3), dtype=np.float32)
         for i in range(N):
@@ -0,0 +1,30 @@
+import numpy as np
+
+from env import VecPyTorch
+
+
+class _PlannerVecEnv():
+    num_envs = 2
+    observation_space = None
+    action_space = None
+
+    def __init__(self):
+        self.calls = []
+
+    def get_short_term_goal(self, inputs):
+        self.calls.append('plan')
+        return np.array([[x['goal'], 0] for x in inputs])
+
+    def close(self):
+        pass
+
+
+def test_async_short_term_goal_waits_before_sending():
+    venv = _PlannerVecEnv()
+    envs = VecPyTorch(venv, 'cpu')
+    envs.get_short_term_goal_async([{'goal': 1}, {'goal': 2}],
+                                   wait=lambda: venv.calls.append('wait'))
+    stg = envs.get_short_term_goal_wait()
+    envs.close()
+    assert venv.calls == ['wait', 'plan']
+    assert stg.tolist() == [[1., 0.], [2., 0.]]
@@ -15,6 +15,7 @@
 
 """Utilities for processing depth images.
 """
+import functools
 from argparse import Namespace
 
 import numpy as np
@@ -32,6 +33,19 @@ def get_camera_matrix(width, height, fov):
     return camera_matrix
 
 
+@functools.lru_cache(maxsize=32)
+def _get_pixel_offsets(height, width, scale, xc, zc):
+    """Returns the cached (x - xc) and (z - zc) pixel offset tables for a
+    HxW image subsampled by scale. The tables are read-only and shared
+    between calls."""
+    x, z = np.meshgrid(np.arange(width), np.arange(height - 1, -1, -1))
+    x = x[::scale, ::scale] - xc
+    z = z[::scale, ::scale] - zc
+    x.setflags(write=False)
+    z.setflags(write=False)
+    return x, z
+
+
 def get_point_cloud_from_z(Y, camera_matrix, scale=1):
     """Projects the depth image Y into a 3D point cloud.
     Inputs:
@@ -43,15 +57,12 @@ def get_point_cloud_from_z(Y, camera_matrix, scale=1):
         Z is positive up in the image
         XYZ is ...xHxWx3
     """
-    x, z = np.meshgrid(np.arange(Y.shape[-1]),
-                       np.arange(Y.shape[-2] - 1, -1, -1))
-    for i in range(Y.ndim - 2):
-        x = np.expand_dims(x, axis=0)
-        z = np.expand_dims(z, axis=0)
-    X = (x[::scale, ::scale] - camera_matrix.xc) * Y[::scale, ::scale] / camera_matrix.f
-    Z = (z[::scale, ::scale] - camera_matrix.zc) * Y[::scale, ::scale] / camera_matrix.f
-    XYZ = np.concatenate((X[..., np.newaxis], Y[::scale, ::scale][..., np.newaxis],
-                          Z[..., np.newaxis]), axis=X.ndim)
+    x, z = _get_pixel_offsets(Y.shape[-2], Y.shape[-1], scale,
+                              camera_matrix.xc, camera_matrix.zc)
+    Y = Y[..., ::scale, ::scale]
+    X = x * Y / camera_matrix.f
+    Z = z * Y / camera_matrix.f
+    XYZ = np.stack((X, Y, Z), axis=-1)
     return XYZ
 
 
@@ -84,37 +95,141 @@ def transform_pose(XYZ, current_pose):
     """
     R = ru.get_r_matrix([0., 0., 1.], angle=current_pose[2] - np.pi / 2.)
     XYZ = np.matmul(XYZ.reshape(-1, 3), R.T).reshape(XYZ.shape)
-    XYZ[:, :, 0] = XYZ[:, :, 0] + current_pose[0]
-    XYZ[:, :, 1] = XYZ[:, :, 1] + current_pose[1]
+    XYZ[..., 0] = XYZ[..., 0] + current_pose[0]
+    XYZ[..., 1] = XYZ[..., 1] + current_pose[1]
+    return XYZ
+
+
+def transform_pose_batch(XYZ, current_poses):
+    """
+    Transforms a stack of point clouds into geocentric frame, using a
+    different camera position for every frame
+    Input:
+        XYZ                     : NxHxWx3
+        current_poses           : Nx3 camera positions (x, y, theta (radians))
+    Output:
+        XYZ : NxHxWx3
+    """
+    current_poses = np.asarray(current_poses, dtype=np.float64)
+    R = np.stack([ru.get_r_matrix([0., 0., 1.], angle=pose[2] - np.pi / 2.)
+                  for pose in current_poses])
+    sh = XYZ.shape
+    XYZ = np.matmul(XYZ.reshape(sh[0], -1, 3),
+                    R.transpose(0, 2, 1)).reshape(sh)
+    XYZ[..., 0] += current_poses[:, 0].reshape([-1] + [1] * (len(sh) - 2))
+    XYZ[..., 1] += current_poses[:, 1].reshape([-1] + [1] * (len(sh) - 2))
     return XYZ
 
 
+def _digitize_points(XYZ_cms, map_size, z_bins, xy_resolution):
+    """Returns the x, y and z bins of every point and whether the point
+    falls inside the map.
+    XYZ_cms is ... x 3
+    Outputs are ...
+    """
+    n_z_bins = len(z_bins) + 1
+    isnotnan = np.logical_not(np.isnan(XYZ_cms[..., 0]))
+    with np.errstate(invalid="ignore"):
+        X_bin = np.round(XYZ_cms[..., 0] / xy_resolution).astype(np.int32)
+        Y_bin = np.round(XYZ_cms[..., 1] / xy_resolution).astype(np.int32)
+    Z_bin = np.digitize(XYZ_cms[..., 2], bins=z_bins).astype(np.int32)
+
+    isvalid = (X_bin >= 0) & (X_bin < map_size) & \
+              (Y_bin >= 0) & (Y_bin < map_size) & \
+              (Z_bin >= 0) & (Z_bin < n_z_bins) & isnotnan
+    return X_bin, Y_bin, Z_bin, isvalid
+
+
+def _get_bin_indices(XYZ_cms, map_size, z_bins, xy_resolution):
+    """Returns the flat per-frame bin index and validity of every point.
+    XYZ_cms is N x H x W x 3
+    Outputs are N x (H*W)
+    """
+    n_z_bins = len(z_bins) + 1
+    XYZ_cms = XYZ_cms.reshape(XYZ_cms.shape[0], -1, 3)
+    X_bin, Y_bin, Z_bin, isvalid = _digitize_points(XYZ_cms, map_size,
+                                                    z_bins, xy_resolution)
+
+    ind = (Y_bin * map_size + X_bin) * n_z_bins + Z_bin
+    ind[np.logical_not(isvalid)] = 0
+    return ind, isvalid
+
+
 def bin_points(XYZ_cms, map_size, z_bins, xy_resolution):
     """Bins points into xy-z bins
     XYZ_cms is ... x H x W x3
     Outputs is ... x map_size x map_size x (len(z_bins)+1)
+
+    All frames are binned with a single bincount, frame i using the
+    index range [i * map_size * map_size * (len(z_bins)+1), (i+1) * ...).
+    The int64 counts of all frames are allocated at once, e.g. about 400MB
+    for 72 frames of a 480x480 map with 3 z bins.
     """
     sh = XYZ_cms.shape
     XYZ_cms = XYZ_cms.reshape([-1, sh[-3], sh[-2], sh[-1]])
+    n_frames = XYZ_cms.shape[0]
     n_z_bins = len(z_bins) + 1
-    counts = []
-    isvalids = []
-    for XYZ_cm in XYZ_cms:
-        isnotnan = np.logical_not(np.isnan(XYZ_cm[:, :, 0]))
-        X_bin = np.round(XYZ_cm[:, :, 0] / xy_resolution).astype(np.int32)
-        Y_bin = np.round(XYZ_cm[:, :, 1] / xy_resolution).astype(np.int32)
-        Z_bin = np.digitize(XYZ_cm[:, :, 2], bins=z_bins).astype(np.int32)
-
-        isvalid = np.array([X_bin >= 0, X_bin < map_size, Y_bin >= 0, Y_bin < map_size,
-                            Z_bin >= 0, Z_bin < n_z_bins, isnotnan])
-        isvalid = np.all(isvalid, axis=0)
-
-        ind = (Y_bin * map_size + X_bin) * n_z_bins + Z_bin
-        ind[np.logical_not(isvalid)] = 0
-        count = np.bincount(ind.ravel(), isvalid.ravel().astype(np.int32),
-                            minlength=map_size * map_size * n_z_bins)
-        counts = np.reshape(count, [map_size, map_size, n_z_bins])
+    frame_size = map_size * map_size * n_z_bins
+
+    ind, isvalid = _get_bin_indices(XYZ_cms, map_size, z_bins, xy_resolution)
+    ind = ind.astype(np.int64) + \
+        np.arange(n_frames, dtype=np.int64)[:, np.newaxis] * frame_size
+    counts = np.bincount(ind.ravel(), isvalid.ravel().astype(np.int32),
+                         minlength=n_frames * frame_size)
 
     counts = counts.reshape(list(sh[:-3]) + [map_size, map_size, n_z_bins])
 
     return counts
+
+
+def bin_points_window(XYZ_cm, map_size, z_bins, xy_resolution):
+    """Bins the points of a single frame into xy-z bins, only over the
+    bounding box of the cells the frame touches.
+    XYZ_cm is H x W x 3
+    Outputs:
+        counts : (y2 - y1) x (x2 - x1) x (len(z_bins)+1)
+        bounds : (y1, y2, x1, x2) in map cells, None if no point is valid
+    counts is equal to bin_points(...)[y1:y2, x1:x2] and the full map is
+    zero outside of the bounds.
+    """
+    n_z_bins = len(z_bins) + 1
+    X_bin, Y_bin, Z_bin, isvalid = _digitize_points(XYZ_cm, map_size,
+                                                    z_bins, xy_resolution)
+    X_bin, Y_bin, Z_bin = X_bin[isvalid], Y_bin[isvalid], Z_bin[isvalid]
+    if X_bin.size == 0:
+        return np.zeros((0, 0, n_z_bins), dtype=np.int64), None
+
+    x1, x2 = X_bin.min(), X_bin.max() + 1
+    y1, y2 = Y_bin.min(), Y_bin.max() + 1
+    w, h = x2 - x1, y2 - y1
+
+    ind = ((Y_bin - y1) * w + (X_bin - x1)) * n_z_bins + Z_bin
+    counts = np.bincount(ind, minlength=h * w * n_z_bins)
+    counts = counts.reshape([h, w, n_z_bins])
+
+    return counts, (int(y1), int(y2), int(x1), int(x2))
+
+
+def project_depth_batch(depth, camera_matrix, scale, sensor_height,
+                        camera_elevation_degree, current_poses, map_size,
+                        z_bins, xy_resolution):
+    """Projects a stack of depth images into binned geocentric counts.
+    Inputs:
+        depth           : NxHxW depth images (cm), NaN for invalid pixels
+        camera_matrix   : camera matrix shared by all frames
+        scale           : pixel subsampling
+        sensor_height   : height of the sensor
+        camera_elevation_degree : camera elevation to rectify
+        current_poses   : Nx3 camera positions (x, y, theta (radians))
+    Output:
+        counts : N x map_size x map_size x (len(z_bins)+1), int64
+    The counts are equal to running get_point_cloud_from_z,
+    transform_camera_view, transform_pose and bin_points on every frame.
+    They take N * map_size**2 * (len(z_bins)+1) * 8 bytes, so large batches
+    on full size maps should be split, or binned with bin_points_window.
+    """
+    point_cloud = get_point_cloud_from_z(depth, camera_matrix, scale=scale)
+    point_cloud = transform_camera_view(point_cloud, sensor_height,
+                                        camera_elevation_degree)
+    point_cloud = transform_pose_batch(point_cloud, current_poses)
+    return bin_points(point_cloud, map_size, z_bins, xy_resolution)
@@ -1,3 +1,5 @@
+import collections
+import functools
 import pathlib
 import sys
 import site
@@ -14,29 +16,43 @@ from numpy import ma
 num_rots = 36
 
 
-def get_mask(sx, sy, scale, step_size):
+def _get_sq_dist(sx, sy, scale, step_size):
     size = int(step_size // scale) * 2 + 1
-    mask = np.zeros((size, size))
-    for i in range(size):
-        for j in range(size):
-            if ((i + 0.5) - (size // 2 + sx)) ** 2 + ((j + 0.5) - (size // 2 + sy)) ** 2 <= \
-                    step_size ** 2:
-                mask[i, j] = 1
+    i, j = np.ogrid[:size, :size]
+    return ((i + 0.5) - (size // 2 + sx)) ** 2 + \
+           ((j + 0.5) - (size // 2 + sy)) ** 2
+
+
+def get_mask(sx, sy, scale, step_size):
+    sq_dist = _get_sq_dist(sx, sy, scale, step_size)
+    mask = (sq_dist <= step_size ** 2).astype(np.float64)
     return mask
 
 
 def get_dist(sx, sy, scale, step_size):
-    size = int(step_size // scale) * 2 + 1
-    mask = np.zeros((size, size)) + 1e-10
-    for i in range(size):
-        for j in range(size):
-            if ((i + 0.5) - (size // 2 + sx)) ** 2 + ((j + 0.5) - (size // 2 + sy)) ** 2 <= \
-                    step_size ** 2:
-                mask[i, j] = max(5, (((i + 0.5) - (size // 2 + sx)) ** 2 +
-                                     ((j + 0.5) - (size // 2 + sy)) ** 2) ** 0.5)
+    sq_dist = _get_sq_dist(sx, sy, scale, step_size)
+    mask = np.zeros(sq_dist.shape) + 1e-10
+    inside = sq_dist <= step_size ** 2
+    mask[inside] = np.maximum(5, sq_dist[inside] ** 0.5)
     return mask
 
 
+@functools.lru_cache(maxsize=1024)
+def _get_kernels(sx, sy, scale, step_size):
+    mask = get_mask(sx, sy, scale, step_size)
+    dist = get_dist(sx, sy, scale, step_size)
+    mask.setflags(write=False)
+    dist.setflags(write=False)
+    return mask, dist
+
+
+def get_kernels(sx, sy, scale, step_size):
+    """Returns the cached (mask, dist) kernels for the sub-cell offset
+    (sx, sy). Kernels are cached on the exact offsets, the returned arrays
+    are shared and read-only."""
+    return _get_kernels(float(sx), float(sy), scale, step_size)
+
+
 class FMMPlanner():
     def __init__(self, traversible, num_rots, scale=1, step_size=5):
         self.scale = scale
@@ -53,6 +69,12 @@ class FMMPlanner():
         self.du = int(self.step_size / (self.scale * 1.))
         self.num_rots = num_rots
 
+        # Local window FMM results keyed by the local traversible patch
+        self.local_fmm_cache = collections.OrderedDict()
+        self.local_fmm_cache_size = 256
+        self.traversible_padded = np.pad(self.traversible, self.du,
+                                         'constant', constant_values=0)
+
     def set_goal(self, goal):
         traversible_ma = ma.masked_values(self.traversible * 1, 0)
         goal_x, goal_y = int(goal[0] / (self.scale * 1.)), \
@@ -62,46 +84,57 @@ class FMMPlanner():
         dd_mask = np.invert(np.isnan(ma.filled(dd, np.nan)))
         dd = ma.filled(dd, np.max(dd) + 1)
         self.fmm_dist = dd
+        self.fmm_dist_padded = np.pad(self.fmm_dist, self.du, 'constant',
+                                      constant_values=self.fmm_dist.shape[0] ** 2)
         return dd_mask
 
+    def _get_local_fmm_dist(self, subset_trav):
+        """Returns the FMM distance from the centre of a local traversible
+        patch, cached on the contents of the patch."""
+        key = subset_trav.tobytes()
+        if key in self.local_fmm_cache:
+            self.local_fmm_cache.move_to_end(key)
+            return self.local_fmm_cache[key]
+
+        traversible_ma = ma.masked_values(subset_trav * 1, 0)
+        goal_x, goal_y = self.du, self.du
+        traversible_ma[goal_y, goal_x] = 0
+        dd = skfmm.distance(traversible_ma, dx=1)
+        dd = ma.filled(dd, np.max(dd) + 1)
+        dd[dd < 4] = 4.
+        dd.setflags(write=False)
+
+        self.local_fmm_cache[key] = dd
+        if len(self.local_fmm_cache) > self.local_fmm_cache_size:
+            self.local_fmm_cache.popitem(last=False)
+        return dd
+
     def get_short_term_goal(self, state):
         scale = self.scale * 1.
         state = [x / scale for x in state]
         dx, dy = state[0] - int(state[0]), state[1] - int(state[1])
-        mask = get_mask(dx, dy, scale, self.step_size)
-        dist_mask = get_dist(dx, dy, scale, self.step_size)
+        mask, dist_mask = get_kernels(dx, dy, scale, self.step_size)
 
         state = [int(x) for x in state]
 
-        dist = np.pad(self.fmm_dist, self.du,
-                      'constant', constant_values=self.fmm_dist.shape[0] ** 2)
-        subset = dist[state[0]:state[0] + 2 * self.du + 1,
-                 state[1]:state[1] + 2 * self.du + 1]
+        subset = self.fmm_dist_padded[state[0]:state[0] + 2 * self.du + 1,
+                                      state[1]:state[1] + 2 * self.du + 1]
 
         assert subset.shape[0] == 2 * self.du + 1 and \
                subset.shape[1] == 2 * self.du + 1, \
             "Planning error: unexpected subset shape {}".format(subset.shape)
 
-        subset *= mask
+        subset = subset * mask
         subset += (1 - mask) * self.fmm_dist.shape[0] ** 2
         subset -= subset[self.du, self.du]
         ratio1 = subset / dist_mask
         subset[ratio1 < -1.5] = 1
 
-        trav = np.pad(self.traversible, self.du,
-                      'constant', constant_values=0)
-
-        subset_trav = trav[state[0]:state[0] + 2 * self.du + 1,
-                      state[1]:state[1] + 2 * self.du + 1]
-        traversible_ma = ma.masked_values(subset_trav * 1, 0)
-        goal_x, goal_y = self.du, self.du
-        traversible_ma[goal_y, goal_x] = 0
-        dd = skfmm.distance(traversible_ma, dx=1)
-        dd_mask = np.invert(np.isnan(ma.filled(dd, np.nan)))
-        dd = ma.filled(dd, np.max(dd) + 1)
-        subset_fmm_dist = dd
+        subset_trav = self.traversible_padded[
+                        state[0]:state[0] + 2 * self.du + 1,
+                        state[1]:state[1] + 2 * self.du + 1]
+        subset_fmm_dist = self._get_local_fmm_dist(subset_trav)
 
-        subset_fmm_dist[subset_fmm_dist < 4] = 4.
         subset = subset / subset_fmm_dist
         subset[subset < -1.5] = 1
         (stg_x, stg_y) = np.unravel_index(np.argmin(subset), subset.shape)
@@ -23,10 +23,9 @@ class MapBuilder(object):
         self.du_scale = params['du_scale']
         self.visualize = params['visualize']
         self.obs_threshold = params['obs_threshold']
+        self.incremental = params['incremental']
 
-        self.map = np.zeros((self.map_size_cm // self.resolution,
-                             self.map_size_cm // self.resolution,
-                             len(self.z_bins) + 1), dtype=np.float32)
+        self.reset_map(self.map_size_cm)
 
         self.agent_height = params['agent_height']
         self.agent_view_angle = params['agent_view_angle']
@@ -62,6 +61,10 @@ class MapBuilder(object):
 
         geocentric_pc = du.transform_pose(agent_view, current_pose)
 
+        if self.incremental:
+            map_gt, explored_gt = self._update_map_window(geocentric_pc)
+            return agent_view_cropped, map_gt, agent_view_explored, explored_gt
+
         geocentric_flat = du.bin_points(
             geocentric_pc,
             self.map.shape[0],
@@ -79,6 +82,34 @@ class MapBuilder(object):
 
         return agent_view_cropped, map_gt, agent_view_explored, explored_gt
 
+    def _update_map_window(self, geocentric_pc):
+        """Adds the geocentric point cloud to the map, touching only the
+        bounding box of the cells it falls into, and refreshes the
+        thresholded maps inside that box. Returns the thresholded maps
+        themselves, they are owned by the builder and updated in place by
+        the next call, so callers keeping them across steps must copy them."""
+        counts, bounds = du.bin_points_window(
+            geocentric_pc,
+            self.map.shape[0],
+            self.z_bins,
+            self.resolution)
+
+        if bounds is not None:
+            y1, y2, x1, x2 = bounds
+            window = self.map[y1:y2, x1:x2]
+            window += counts
+
+            map_gt = window[:, :, 1] / self.obs_threshold
+            map_gt[map_gt >= 0.5] = 1.0
+            map_gt[map_gt < 0.5] = 0.0
+            self.map_gt[y1:y2, x1:x2] = map_gt
+
+            explored_gt = window.sum(2)
+            explored_gt[explored_gt > 1] = 1.0
+            self.explored_gt[y1:y2, x1:x2] = explored_gt
+
+        return self.map_gt, self.explored_gt
+
     def get_st_pose(self, current_loc):
         loc = [- (current_loc[0] / self.resolution
                   - self.map_size_cm // (self.resolution * 2)) / \
@@ -96,5 +127,10 @@ class MapBuilder(object):
                              self.map_size_cm // self.resolution,
                              len(self.z_bins) + 1), dtype=np.float32)
 
+        # Thresholded maps, only maintained in incremental mode. In double
+        # precision like the maps of the full update.
+        self.map_gt = np.zeros(self.map.shape[:2])
+        self.explored_gt = np.zeros(self.map.shape[:2])
+
     def get_map(self):
         return self.map
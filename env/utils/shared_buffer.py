@@ -0,0 +1,76 @@
+import numpy as np
+import torch
+
+
+class SharedRingBuffer(object):
+    """
+    Per-env ring buffers in shared memory used to pass observations and
+    maps from the env workers to the trainer without pickling them.
+
+    The buffer is created in the main process and handed to every worker.
+    A worker writes its arrays into the next slot of its own ring and only
+    sends the slot index through the pipe. Arrays read from a slot stay
+    valid until the worker has written num_slots - 1 further steps.
+    """
+
+    def __init__(self, num_envs, fields, num_slots=2):
+        """
+        fields: dict of name -> (shape, torch dtype)
+        """
+        self.num_envs = num_envs
+        self.num_slots = num_slots
+        self.tensors = {}
+        for name, (shape, dtype) in fields.items():
+            self.tensors[name] = torch.zeros(
+                (num_envs, num_slots) + tuple(shape),
+                dtype=dtype).share_memory_()
+        self.next_slot = np.zeros(num_envs, dtype=np.int64)
+        self._arrays = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    @property
+    def arrays(self):
+        # numpy views of the shared tensors, created lazily in each process
+        if self._arrays is None:
+            self._arrays = {name: tensor.numpy()
+                            for name, tensor in self.tensors.items()}
+        return self._arrays
+
+    def write(self, rank, **values):
+        """Writes values to the next slot of env rank, returns the slot."""
+        slot = int(self.next_slot[rank])
+        self.next_slot[rank] = (slot + 1) % self.num_slots
+        arrays = self.arrays
+        for name, value in values.items():
+            arrays[name][rank, slot] = value
+        return slot
+
+    def read(self, name, slots):
+        """
+        Returns a tensor stacking field name of every env at the given
+        slots (one per env). This copies the data out of the ring.
+        """
+        slots = torch.as_tensor(np.asarray(slots, dtype=np.int64))
+        envs = torch.arange(self.num_envs)
+        return self.tensors[name][envs, slots]
+
+    def view(self, name, rank, slot):
+        """Returns a numpy view of field name of env rank at slot."""
+        return self.arrays[name][rank, slot]
+
+
+def get_shared_buffer(args, num_envs):
+    """Builds the shared buffer for the observations and maps in env infos."""
+    map_size = args.map_size_cm // args.map_resolution
+    fields = {
+        'obs': ((3, args.frame_height, args.frame_width), torch.uint8),
+        'explored_map': ((map_size, map_size), torch.float32),
+        'fp_proj': ((args.vision_range, args.vision_range), torch.float32),
+        'fp_explored': ((args.vision_range, args.vision_range),
+                        torch.float32),
+    }
+    return SharedRingBuffer(num_envs, fields, args.shared_memory_slots)
@@ -0,0 +1,38 @@
+import numpy as np
+
+import env.utils.depth_utils as du
+
+
+def _get_frames(rng, n_frames):
+    depth = rng.uniform(50., 500., (n_frames, 32, 32))
+    depth[rng.rand(*depth.shape) < 0.1] = np.NaN
+    poses = np.stack([rng.uniform(100., 500., n_frames),
+                      rng.uniform(100., 500., n_frames),
+                      rng.uniform(-np.pi, np.pi, n_frames)], axis=1)
+    return depth, poses
+
+
+def test_transform_pose_batch_matches_per_frame():
+    rng = np.random.RandomState(0)
+    XYZ = rng.uniform(-100., 100., (4, 8, 8, 3))
+    poses = rng.uniform(-np.pi, np.pi, (4, 3))
+    out = du.transform_pose_batch(XYZ.copy(), poses)
+    for i in range(4):
+        assert np.allclose(out[i], du.transform_pose(XYZ[i].copy(), poses[i]))
+
+
+def test_project_depth_batch_matches_per_frame():
+    rng = np.random.RandomState(0)
+    camera_matrix = du.get_camera_matrix(32, 32, 90.)
+    z_bins = [25, 150]
+    depth, poses = _get_frames(rng, 5)
+    counts = du.project_depth_batch(depth, camera_matrix, 2, 125., 0., poses,
+                                    120, z_bins, 5)
+    for i in range(5):
+        point_cloud = du.get_point_cloud_from_z(depth[i], camera_matrix,
+                                                scale=2)
+        point_cloud = du.transform_camera_view(point_cloud, 125., 0.)
+        point_cloud = du.transform_pose(point_cloud, poses[i])
+        expected = du.bin_points(point_cloud, 120, z_bins, 5)
+        assert counts[i].sum() > 0
+        assert np.array_equal(counts[i], expected)
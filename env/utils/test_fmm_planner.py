@@ -0,0 +1,18 @@
+import numpy as np
+
+from env.utils.fmm_planner import get_dist, get_kernels, get_mask
+
+
+def test_cached_kernels_match_uncached():
+    rng = np.random.RandomState(0)
+    offsets = [(0., 0.), (0.5, 0.5), (0., 0.5)] + \
+        [tuple(x) for x in rng.uniform(0., 1., (20, 2))]
+    for scale, step_size in [(1., 5), (2., 5), (1., 3)]:
+        for sx, sy in offsets:
+            for _ in range(2):
+                mask, dist = get_kernels(sx, sy, scale, step_size)
+                assert np.array_equal(mask, get_mask(sx, sy, scale,
+                                                     step_size))
+                assert np.array_equal(dist, get_dist(sx, sy, scale,
+                                                     step_size))
+                assert not mask.flags.writeable
@@ -0,0 +1,38 @@
+import numpy as np
+
+from env.utils.map_builder import MapBuilder
+
+
+def _get_params(incremental):
+    params = {}
+    params['frame_width'] = 64
+    params['frame_height'] = 64
+    params['fov'] = 90.
+    params['resolution'] = 5
+    params['map_size_cm'] = 1200
+    params['agent_min_z'] = 25
+    params['agent_max_z'] = 150
+    params['agent_height'] = 125.
+    params['agent_view_angle'] = 0
+    params['du_scale'] = 1
+    params['vision_range'] = 64
+    params['visualize'] = 0
+    params['obs_threshold'] = 1
+    params['incremental'] = incremental
+    return params
+
+
+def test_incremental_map_matches_full_map():
+    rng = np.random.RandomState(0)
+    full = MapBuilder(_get_params(0))
+    incremental = MapBuilder(_get_params(1))
+    for _ in range(10):
+        depth = rng.uniform(50., 500., (64, 64))
+        pose = (600. + rng.uniform(-100., 100.),
+                600. + rng.uniform(-100., 100.),
+                rng.uniform(-np.pi, np.pi))
+        out_full = full.update_map(depth.copy(), pose)
+        out_inc = incremental.update_map(depth.copy(), pose)
+        for x, y in zip(out_full, out_inc):
+            assert x.dtype == y.dtype
+            assert np.array_equal(x, y)
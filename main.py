@@ -16,8 +16,11 @@ import gym
 import logging
 from arguments import get_args
 from env import gen_vec_envs
-from utils.storage import GlobalRolloutStorage, FIFOMemory
+from utils.storage import GlobalRolloutStorage, FIFOMemory, \
+    CompactSLAMMemory, MemmapSLAMMemory, BatchPrefetcher
 from utils.optimization import get_optimizer
+from utils.map_manager import MapManager
+from utils.rewards import calc_rewards
 from model import RL_Policy, Local_IL_Policy, Neural_SLAM_Module
 
 import algo
@@ -33,41 +36,6 @@ import matplotlib.pyplot as plt
 # fig, ax = plt.subplots(1,4, figsize=(10, 2.5), facecolor="whitesmoke")
 
 
-def get_local_map_boundaries(agent_loc, local_sizes, full_sizes, global_downscaling):
-    loc_r, loc_c = agent_loc
-    local_w, local_h = local_sizes
-    full_w, full_h = full_sizes
-
-    if global_downscaling > 1:
-        gx1, gy1 = loc_r - local_w // 2, loc_c - local_h // 2
-        gx2, gy2 = gx1 + local_w, gy1 + local_h
-        if gx1 < 0:
-            gx1, gx2 = 0, local_w
-        if gx2 > full_w:
-            gx1, gx2 = full_w - local_w, full_w
-
-        if gy1 < 0:
-            gy1, gy2 = 0, local_h
-        if gy2 > full_h:
-            gy1, gy2 = full_h - local_h, full_h
-    else:
-        gx1, gx2, gy1, gy2 = 0, full_w, 0, full_h
-
-    return [gx1, gx2, gy1, gy2]
-
-def calc_rewards(current_explored_area, previously_explored_area):
-    """
-    current_explored_area: tensor of size[num_agents, <dimensions of explored area>]
-    previously_explored_area: tensor of size[<dimensions of explored area>]
-    """
-    new_explored_area = torch.zeros_like(current_explored_area)
-    for a_ix, a in enumerate(current_explored_area):
-        # a is the area explored by one of the agents that
-        z = ((torch.sum(current_explored_area, dim = 0) - a) > 0.5).float()
-        new_explored_area[a_ix] = ((a - z - previously_explored_area.float()) > 0).float()*10 + a*0.01
-    rewards = new_explored_area.sum(dim=tuple(range(1,new_explored_area.dim()))) * 0.0005 # actually 0.0005 but I modified it
-    return rewards
-
 def viz(full_map, ep_no, t, res_dir):
     for i in range (0, full_map.shape[0]):
         ag_no = str(i+1)
@@ -165,26 +133,16 @@ def main():
     local_w, local_h = int(full_w / args.global_downscaling), \
                     int(full_h / args.global_downscaling)
 
-    # Initializing full and local map
-    full_map = torch.zeros((num_scenes, 5, full_w, full_h), dtype=torch.float32, device=device)  ##############
-    local_map = torch.zeros((num_scenes, 4, local_w, local_h), dtype=torch.float32, device=device)    #############
+    # Full and local maps with their boundaries, origins and poses
+    map_manager = MapManager(args, num_scenes, device)
+    full_map = map_manager.full_map
+    local_map = map_manager.local_map
+    planner_pose_inputs = map_manager.planner_pose_inputs
 
-    # Initial full and local pose
-    full_pose = torch.zeros((num_scenes, 3), dtype=torch.float32, device=device)  ###############
+    # Initial local pose
     local_pose = torch.zeros((num_scenes, 3), dtype=torch.float32, device=device)
     poses = torch.zeros((num_scenes, 3), dtype=torch.float32, device=device)
 
-    # Origin of local map
-    origins = np.zeros((num_scenes, 3))   ########?????????
-
-    # Local Map Boundaries
-    lmb = np.zeros((num_scenes, 4)).astype(int)     ##########??????????
-
-    ### Planner pose inputs has 7 dimensions
-    ### 1-3 store continuous global agent location
-    ### 4-7 store local map boundaries
-    planner_pose_inputs = np.zeros((num_scenes, 7))   ##########
-
     # Global policy observation space
     g_observation_space = gym.spaces.Box(0, 1,
                                         (9,
@@ -227,7 +185,28 @@ def main():
                                     g_action_space, g_policy.rec_state_size,
                                     1, device)
 
-    slam_memory = FIFOMemory(args.slam_memory_size)
+    if args.slam_memory_path != "0":
+        # Resumes from the replay file if it exists
+        slam_memory = MemmapSLAMMemory(args.slam_memory_size,
+                                       args.slam_memory_path,
+                                       pin_memory=args.cuda)
+    elif args.compact_slam_memory:
+        slam_memory = CompactSLAMMemory(args.slam_memory_size,
+                                        pin_memory=args.cuda)
+    else:
+        # RGB frames are stored as uint8 and projections as float16
+        slam_memory = FIFOMemory(args.slam_memory_size,
+                                 in_dtypes=[torch.uint8, torch.uint8,
+                                            torch.float32],
+                                 out_dtypes=[torch.float16, torch.float16,
+                                             torch.float32],
+                                 pin_memory=args.cuda)
+
+    # Samples SLAM training batches on a background thread
+    slam_loader = None
+    if args.train_slam and args.slam_prefetch > 0:
+        slam_loader = BatchPrefetcher(slam_memory, args.slam_batch_size,
+                                      args.slam_prefetch, device)
 
     # Loading model   ###########
     if args.load_slam != "0":
@@ -239,6 +218,36 @@ def main():
     if not args.train_slam:
         nslam_module.eval()
 
+    # Trains a copy of the SLAM module on a background thread
+    slam_learner = None
+    if args.train_slam and args.async_slam:
+        slam_learner = algo.SLAMLearner(
+            nslam_module,
+            lambda params: get_optimizer(params, args.slam_optimizer),
+            slam_memory, args, device, (costs, exp_costs, pose_costs),
+            updates_per_step=args.slam_iterations,
+            publish_interval=args.slam_publish_interval,
+            prefetcher=slam_loader)
+
+    # The optimizer state of the async SLAM learner is saved next to the
+    # weights, synchronous checkpoints only hold the weights
+    if slam_learner is not None and args.load_slam != "0" and \
+            os.path.exists(args.load_slam + "_optimizer"):
+        state_dict = torch.load(args.load_slam + "_optimizer",
+                                map_location=lambda storage, loc: storage)
+        slam_learner.load_optimizer_state_dict(state_dict)
+
+    def save_slam(path):
+        if slam_learner is None:
+            torch.save(nslam_module.state_dict(), path)
+            return
+        # The actor module lags behind the async learner, save the weights
+        # of the learner after loading them into the actor
+        state_dict, optimizer_state_dict = slam_learner.state_dicts()
+        nslam_module.load_state_dict(state_dict)
+        torch.save(state_dict, path)
+        torch.save(optimizer_state_dict, path + "_optimizer")
+
     if args.load_global != "0":
         print("Loading global {}".format(args.load_global))
         state_dict = torch.load(args.load_global,
@@ -248,38 +257,6 @@ def main():
     if not args.train_global:
         g_policy.eval()
 
-    def init_map_and_pose():
-        full_map.fill_(0.)
-        full_pose.fill_(0.)
-        full_pose[:, :2] = args.map_size_cm / 100.0 / 2.0  ###################
-
-        locs = full_pose.cpu().numpy()
-        planner_pose_inputs[:, :3] = locs  ##############
-          ####################
-        for e in range(num_scenes):
-            r, c = locs[e, 1], locs[e, 0]
-            loc_r, loc_c = [int(r * 100.0 / args.map_resolution),
-                            int(c * 100.0 / args.map_resolution)]
-
-            full_map[e, 2:, loc_r - 1:loc_r + 2, loc_c - 1:loc_c + 2] = 1.0
-
-            lmb[e] = get_local_map_boundaries((loc_r, loc_c),
-                                            (local_w, local_h),
-                                            (full_w, full_h),
-                                            args.global_downscaling)
-
-            planner_pose_inputs[e, 3:] = lmb[e]
-            origins[e] = [lmb[e][2] * args.map_resolution / 100.0,
-                        lmb[e][0] * args.map_resolution / 100.0, 0.]
-
-        full_map[:,0] = torch.max(full_map[:,0], dim = 0).values
-        full_map[:,1] = torch.max(full_map[:,1], dim = 0).values
-        full_map[:,4] = torch.max(full_map[:,2], dim = 0).values
-        for e in range(num_scenes):
-            local_map[e] = full_map[e, :4, lmb[e, 0]:lmb[e, 1], lmb[e, 2]:lmb[e, 3]]
-            local_pose[e] = full_pose[e] - \
-                            torch.from_numpy(origins[e]).float().to(device)
-
     for envs in gen_vec_envs(args):
         obs, infos = envs.reset() #########??????????
         previously_explored_area = torch.zeros(infos[0]['explorable_map'].shape, dtype=torch.int32 ,device=device)  ##########
@@ -307,7 +284,8 @@ def main():
                 obs, infos = envs.reset() #########??????????
                 previously_explored_area = torch.zeros(infos[0]['explorable_map'].shape, dtype=torch.int32 ,device=device)  ##########
                 obs = obs.to(device)      
-                init_map_and_pose()
+                local_pose = map_manager.reset()
+                nslam_module.reset_pred_cache()
 
                 # Predict map from frame 1:
                 # poses = torch.tensor(
@@ -322,20 +300,12 @@ def main():
                                 local_map[:, 1, :, :], local_pose)
 
                 # Compute Global policy input
-                locs = local_pose.cpu().numpy()
                 global_input = torch.zeros(num_scenes, 9, local_w, local_h)   ##############
-                global_orientation = torch.zeros(num_scenes, 1).long()
-
-                for e in range(num_scenes):
-                    r, c = locs[e, 1], locs[e, 0]
-                    loc_r, loc_c = [int(r * 100.0 / args.map_resolution),
-                                    int(c * 100.0 / args.map_resolution)]
-
-                    local_map[e, 2:, loc_r - 1:loc_r + 2, loc_c - 1:loc_c + 2] = 1.
-                    global_orientation[e] = int((locs[e, 2] + 180.0) / 5.)
+                map_manager.stamp_location(local_pose, 1, clear=False)
+                global_orientation = map_manager.get_orientation(local_pose)
 
                 global_input[:, 0:4, :, :] = local_map.detach()
-                global_input[:, 4:, :, :] = nn.MaxPool2d(args.global_downscaling)(full_map)
+                global_input[:, 4:, :, :] = map_manager.pooled_map
 
                 g_rollouts.obs[0].copy_(global_input)
                 g_rollouts.extras[0].copy_(global_orientation)
@@ -355,14 +325,16 @@ def main():
                                 for action in cpu_actions]
 
                 # Compute planner inputs
+                planner_maps = map_manager.get_planner_maps()
                 planner_inputs = [{} for e in range(num_scenes)]
                 for e, p_input in enumerate(planner_inputs):
                     p_input['goal'] = global_goals[e]
-                    p_input['map_pred'] = global_input[e, 0, :, :].detach().cpu().numpy()
-                    p_input['exp_pred'] = global_input[e, 1, :, :].detach().cpu().numpy()
+                    p_input['map_pred'] = planner_maps[e, 0]
+                    p_input['exp_pred'] = planner_maps[e, 1]
                     p_input['pose_pred'] = planner_pose_inputs[e]
 
                 # Output stores local goals as well as the the ground-truth action
+                map_manager.wait_planner_maps()
                 output = envs.get_short_term_goal(planner_inputs).long().to(device)
 
                 last_obs = obs.detach()
@@ -414,13 +386,17 @@ def main():
 
                     l_masks = torch.tensor([0 if x else 1 for x in done], 
                                             dtype=torch.float32, device=device)
+                    # obs of finished envs start a new episode, their
+                    # cached SLAM predictions are not the last obs anymore
+                    if np.any(done):
+                        nslam_module.reset_pred_cache(np.flatnonzero(done))
                     g_masks *= l_masks
                     # ------------------------------------------------------------------
 
                     # ------------------------------------------------------------------
                     # Reinitialize variables when episode ends
                     if step == args.max_episode_length - 1:  # Last episode step
-                        init_map_and_pose()
+                        local_pose = map_manager.reset()
                         del last_obs
                         last_obs = obs.detach()
                     # ------------------------------------------------------------------
@@ -437,7 +413,8 @@ def main():
                             env_gt_pose_err = torch.tensor(infos[env_idx]['pose_err'], dtype=torch.float32)
                             slam_memory.push(
                                 (last_obs[env_idx], env_obs, env_poses),
-                                (env_gt_fp_projs, env_gt_fp_explored, env_gt_pose_err))
+                                (env_gt_fp_projs, env_gt_fp_explored, env_gt_pose_err),
+                                stream=env_idx)
                     
                     obs = obs.to(device)
                     last_obs = last_obs.to(device)
@@ -452,15 +429,9 @@ def main():
                         nslam_module(last_obs, obs, poses, local_map[:, 0, :, :],
                                     local_map[:, 1, :, :], local_pose, build_maps=True)
 
-                    locs = local_pose.cpu().numpy()
-                    planner_pose_inputs[:, :3] = locs + origins
-                    local_map[:, 2, :, :].fill_(0.)  # Resetting current location channel
-                    for e in range(num_scenes):
-                        r, c = locs[e, 1], locs[e, 0]
-                        loc_r, loc_c = [int(r * 100.0 / args.map_resolution),
-                                        int(c * 100.0 / args.map_resolution)]
-
-                        local_map[e, 2:, loc_r - 2:loc_r + 3, loc_c - 2:loc_c + 3] = 1.
+                    map_manager.update_planner_pose(local_pose)
+                    # Resetting current location channel
+                    map_manager.stamp_location(local_pose, 2, clear=True)
                     # ------------------------------------------------------------------
 
                     # ------------------------------------------------------------------
@@ -468,48 +439,10 @@ def main():
                     if l_step == args.num_local_steps - 1:
                         # print("Updating global policy")
                         # For every global step, update the full and local maps
-                        full_pose_cpu = full_pose.cpu()
-                        local_pose_cpu = local_pose.cpu()
-                        for e in range(num_scenes):
-                            full_map[e, :4, lmb[e, 0]:lmb[e, 1], lmb[e, 2]:lmb[e, 3]] = \
-                                local_map[e]
-                            full_pose_cpu[e] = local_pose_cpu[e] +  \
-                                torch.from_numpy(origins[e]).float()
-
-                            locs = full_pose_cpu[e]
-                            r, c = locs[1], locs[0]
-                            loc_r, loc_c = [int(r * 100.0 / args.map_resolution),
-                                            int(c * 100.0 / args.map_resolution)]
-
-                            lmb[e] = get_local_map_boundaries((loc_r, loc_c),
-                                                            (local_w, local_h),
-                                                            (full_w, full_h),
-                                                            args.global_downscaling)
-
-                            planner_pose_inputs[e, 3:] = lmb[e]
-                            origins[e] = [lmb[e][2] * args.map_resolution / 100.0,
-                                        lmb[e][0] * args.map_resolution / 100.0, 0.]
-
-                        ############################# update
-                        full_map[:,0] = torch.max(full_map[:,0], dim = 0).values
-                        full_map[:,1] = torch.max(full_map[:,1], dim = 0).values
-                        full_map[:,4] = torch.max(full_map[:,2], dim = 0).values
-
-                        for e in range(num_scenes):
-                            local_map[e] = full_map[e, :4,
-                                        lmb[e, 0]:lmb[e, 1], lmb[e, 2]:lmb[e, 3]]
-                            local_pose_cpu[e] = full_pose_cpu[e] -  \
-                                torch.from_numpy(origins[e]).float()
-
-                        full_pose = full_pose_cpu.to(device)
-                        local_pose = local_pose_cpu.to(device)
-
-                        locs = local_pose_cpu.numpy()
-                        for e in range(num_scenes):
-                            global_orientation[e] = int((locs[e, 2] + 180.0) / 5.)
+                        local_pose = map_manager.update_global(local_pose)
+                        global_orientation = map_manager.get_orientation(local_pose)
                         global_input[:, 0:4, :, :] = local_map
-                        global_input[:, 4:, :, :] = \
-                            nn.MaxPool2d(args.global_downscaling)(full_map)
+                        global_input[:, 4:, :, :] = map_manager.pooled_map
 
                         if False:
                             for i in range(4):
@@ -534,10 +467,15 @@ def main():
                             [info['explored_map'] for info in infos],
                             dtype=torch.float32,device=device)
                         explorable_area = torch.tensor(infos[0]['explorable_map'], dtype=torch.float32,device=device)
-                        test_rewards = calc_rewards(explored_area * explorable_area, previously_explored_area=previously_explored_area)
+                        team_explored_area = torch.max(explored_area, dim = 0).values
+                        changed_cells = torch.nonzero(
+                            (team_explored_area > previously_explored_area).view(-1)).squeeze(1)
+                        test_rewards = calc_rewards(explored_area * explorable_area,
+                                                    previously_explored_area=previously_explored_area,
+                                                    changed_cells=changed_cells)
                         g_reward = test_rewards  ###############
                         print("Calculating reward = ", g_reward)
-                        previously_explored_area = torch.max(explored_area, dim = 0).values
+                        previously_explored_area = team_explored_area
 
                         if args.eval:
                             g_reward = g_reward*50.0 # Convert reward to area in m2
@@ -600,66 +538,55 @@ def main():
 
                     # ------------------------------------------------------------------
                     # Get short term goal
+                    planner_maps = map_manager.get_planner_maps()
                     planner_inputs = [{} for e in range(num_scenes)]
                     for e, p_input in enumerate(planner_inputs):
-                        p_input['map_pred'] = local_map[e, 0, :, :].cpu().numpy()
-                        p_input['exp_pred'] = local_map[e, 1, :, :].cpu().numpy()
+                        p_input['map_pred'] = planner_maps[e, 0]
+                        p_input['exp_pred'] = planner_maps[e, 1]
                         p_input['pose_pred'] = planner_pose_inputs[e]
                         p_input['goal'] = global_goals[e]
 
-                    output = envs.get_short_term_goal(planner_inputs).long().to(device)
+                    if args.async_planner:
+                        # The envs plan during training and logging, the
+                        # goals are collected at the end of the step
+                        envs.get_short_term_goal_async(
+                            planner_inputs, wait=map_manager.wait_planner_maps)
+                    else:
+                        map_manager.wait_planner_maps()
+                        output = envs.get_short_term_goal(planner_inputs).long().to(device)
                     # ------------------------------------------------------------------
 
                     ### TRAINING
                     torch.set_grad_enabled(True)
                     # ------------------------------------------------------------------
                     # Train Neural SLAM Module
-                    if args.train_slam and len(slam_memory) > args.slam_batch_size:
-                        # gen_batch = slam_memory.sample_loader(batch_size=args.slam_batch_size, num_samples=args.slam_iterations, 
-                        #                                             num_processes=1, device=device)
-                        # for sample in gen_batch:
+                    if slam_learner is not None:
+                        # Let the learner run slam_iterations updates for
+                        # this step and use its last published weights
+                        slam_learner.env_step()
+                        slam_learner.sync(nslam_module)
+                    elif args.train_slam and len(slam_memory) > args.slam_batch_size:
+                        if slam_loader is not None:
+                            slam_loader.request(args.slam_iterations)
                         for i in range(args.slam_iterations):
-                            sample = slam_memory.sample(batch_size=args.slam_batch_size)
-                            #print(total_num_steps)
-                            
-                            inputs, outputs = sample
-                            b_obs_last, b_obs, b_poses = inputs
-                            gt_fp_projs, gt_fp_explored, gt_pose_err = outputs
-                            b_obs_last, b_obs, b_poses = [x.to(device) for x in [ b_obs_last, b_obs, b_poses]]
-                            gt_fp_projs, gt_fp_explored, gt_pose_err = [x.to(device) for x in [gt_fp_projs, gt_fp_explored, gt_pose_err]]
-
-                            b_proj_pred, b_fp_exp_pred, _, _, b_pose_err_pred, _ = \
-                                nslam_module(b_obs_last, b_obs, b_poses,
-                                            None, None, None,
-                                            build_maps=False)
-                            loss = 0
-                            if args.proj_loss_coeff > 0:
-                                proj_loss = F.binary_cross_entropy(b_proj_pred,
-                                                                gt_fp_projs)
-                                costs.append(proj_loss.item())
-                                loss += args.proj_loss_coeff * proj_loss
-
-                            if args.exp_loss_coeff > 0:
-                                exp_loss = F.binary_cross_entropy(b_fp_exp_pred,
-                                                                gt_fp_explored)
-                                exp_costs.append(exp_loss.item())
-                                loss += args.exp_loss_coeff * exp_loss
-
-                            if args.pose_loss_coeff > 0:
-                                pose_loss = torch.nn.MSELoss()(b_pose_err_pred,
-                                                            gt_pose_err)
-                                pose_costs.append(args.pose_loss_coeff *
-                                                pose_loss.item())
-                                loss += args.pose_loss_coeff * pose_loss
-
-                            if args.train_slam:
-                                slam_optimizer.zero_grad()
-                                loss.backward()
-                                slam_optimizer.step()
-
-                            del b_obs_last, b_obs, b_poses
-                            del gt_fp_projs, gt_fp_explored, gt_pose_err
-                            del b_proj_pred, b_fp_exp_pred, b_pose_err_pred
+                            if slam_loader is not None:
+                                sample = slam_loader.get()
+                            else:
+                                sample = slam_memory.sample(batch_size=args.slam_batch_size,
+                                                            device=device)
+
+                            loss, slam_costs = algo.compute_slam_loss(
+                                nslam_module, sample, args)
+                            for log, cost in zip((costs, exp_costs, pose_costs),
+                                                 slam_costs):
+                                if cost is not None:
+                                    log.append(cost)
+
+                            slam_optimizer.zero_grad()
+                            loss.backward()
+                            slam_optimizer.step()
+
+                            del sample, loss
 
                     # ------------------------------------------------------------------
 
@@ -688,7 +615,8 @@ def main():
                             ).detach()
 
                             g_rollouts.compute_returns(g_next_value, args.use_gae,
-                                                    args.gamma, args.tau)
+                                                    args.gamma, args.tau,
+                                                    args.vectorized_returns)
                             g_value_loss, g_action_loss, g_dist_entropy = \
                                 g_agent.update(g_rollouts)
                             g_value_losses.append(g_value_loss)
@@ -758,6 +686,15 @@ def main():
                                     np.mean(pose_costs))
                             ])
 
+                        if slam_loader is not None and \
+                                slam_loader.num_batches > 0:
+                            log += " ".join([
+                                " SLAM data wait:",
+                                "{:.4f}s/batch,".format(
+                                    slam_loader.wait_time /
+                                    slam_loader.num_batches)
+                            ])
+
                         print(log)
                         logging.info(log)
                     # ------------------------------------------------------------------
@@ -773,8 +710,7 @@ def main():
                                 and not args.eval:
                             print("model_best.slam: current weight is the best weight.")
                             best_cost = np.mean(costs)
-                            torch.save(nslam_module.state_dict(),
-                                    os.path.join(log_dir, "model_best.slam"))
+                            save_slam(os.path.join(log_dir, "model_best.slam"))
                         else:
                             # print("model_best.slam: current weight is not the best weight.")
                             pass
@@ -805,9 +741,8 @@ def main():
                             num_scenes:
                         step = total_num_steps * num_scenes
                         if args.train_slam:
-                            torch.save(nslam_module.state_dict(),
-                                    os.path.join(dump_dir,
-                                                    "periodic_{}.slam".format(step)))
+                            save_slam(os.path.join(dump_dir,
+                                                   "periodic_{}.slam".format(step)))
                         if args.train_local:
                             torch.save(l_policy.state_dict(),
                                     os.path.join(dump_dir,
@@ -816,8 +751,14 @@ def main():
                             torch.save(g_policy.state_dict(),
                                     os.path.join(dump_dir,
                                                     "periodic_{}.multi_global".format(step)))
+                        if args.train_slam and \
+                                isinstance(slam_memory, MemmapSLAMMemory):
+                            slam_memory.flush()
                     # ------------------------------------------------------------------
 
+                    if args.async_planner:
+                        output = envs.get_short_term_goal_wait().long().to(device)
+
                 # Print and save model performance numbers during evaluation
                 if args.eval:
                     logfile = open("{}/explored_area.txt".format(dump_dir), "w+")
@@ -5,7 +5,8 @@ import torchvision.models as models
 import numpy as np
 
 from utils.distributions import Categorical, DiagGaussian
-from utils.model import get_grid, ChannelPool, Flatten, NNBase
+from utils.model import get_grid, get_affine_theta, warp_affine, \
+    ChannelPool, Flatten, NNBase
 
 
 # Global Policy model code
@@ -154,12 +155,26 @@ class Neural_SLAM_Module(nn.Module):
                                       self.map_size_cm // self.resolution
                                       ).float().to(self.device)
 
-    def forward(self, obs_last, obs, poses, maps, explored, current_poses,
-            build_maps=True):
-
-        # Get egocentric map prediction for the current obs
-        _, c, h, w = obs.size()
-        bs = poses.shape[0]
+        # Predictions of the last build_maps step, reused as pred_last of
+        # the next step since obs_last is then the previous obs
+        self.pred_cache_mode = args.slam_pred_cache
+        self.pred_cache = None
+        self.pred_cache_valid = np.zeros(args.num_processes, dtype=bool)
+
+        # Warp egocentric predictions with a single grid_sample
+        self.fused_warp = args.fused_warp
+
+        # Size of the window around the agent in which the egocentric
+        # prediction is aggregated in place, None to warp the full map
+        self.aggregation_window = None
+        map_size = self.map_size_cm // self.resolution
+        window = int(np.ceil(self.vision_range * np.sqrt(1.25))) * 2 + 4
+        if args.windowed_aggregation and window < map_size:
+            self.aggregation_window = window
+
+    def get_egocentric_pred(self, obs):
+        """Returns the egocentric projection and explored predictions."""
+        bs = obs.shape[0]
         resnet_output = self.resnet_l5(obs[:, :3, :, :])
         conv_output = self.conv(resnet_output)
 
@@ -171,27 +186,100 @@ class Neural_SLAM_Module(nn.Module):
 
         deconv_input = proj3.view(bs, 64, 8, 8)
         deconv_output = self.deconv(deconv_input)
-        pred = torch.sigmoid(deconv_output)
+        return torch.sigmoid(deconv_output)
+
+    def reset_pred_cache(self, envs=None):
+        """
+        Invalidates the cached predictions of the given env indices, or of
+        all envs if envs is None. Must be called when obs_last of an env is
+        not the obs of its previous build_maps step, e.g. on episode reset.
+        """
+        if envs is None:
+            self.pred_cache_valid[:] = False
+        else:
+            self.pred_cache_valid[envs] = False
+
+    def _use_pred_cache(self, bs):
+        if self.pred_cache_mode == 0 or bs != len(self.pred_cache_valid):
+            return False
+        # In training mode the cached prediction was made with other
+        # dropout masks and possibly older weights
+        return self.pred_cache_mode == 2 or not self.training
+
+    def _get_cached_pred_last(self, obs_last):
+        pred_last = self.pred_cache
+        invalid = np.flatnonzero(~self.pred_cache_valid)
+        if pred_last is None or len(invalid) == len(self.pred_cache_valid):
+            return self.get_egocentric_pred(obs_last)
+        if len(invalid) > 0:
+            invalid = torch.from_numpy(invalid).to(obs_last.device)
+            pred_last = pred_last.clone()
+            pred_last[invalid] = self.get_egocentric_pred(obs_last[invalid])
+        return pred_last
+
+    def _aggregate_in_window(self, pred, st_pose, current_poses, maps,
+                             explored):
+        """
+        Warps the egocentric prediction only inside a window around the
+        agent and max-merges it in place into maps and explored. Sampling
+        directly from pred is the same as sampling from the zero-padded
+        agent view, the warp is the fused one of warp_affine.
+        """
+        bs = pred.shape[0]
+        vr = self.vision_range
+        size = self.map_size_cm // self.resolution
+        ws = self.aggregation_window
+        device = pred.device
+
+        # Window around the agent's location in the map, kept inside it
+        locs = (current_poses[:, :2] * 100.0 / self.resolution).floor().long()
+        starts = (locs - ws // 2).clamp(0, size - ws)
+        offsets = torch.arange(ws, device=device)
+        cols = starts[:, 0:1] + offsets
+        rows = starts[:, 1:2] + offsets
+
+        # Sampling grid of the window pixels in the full map
+        xs = (2. * cols.float() + 1.) / size - 1.
+        ys = (2. * rows.float() + 1.) / size - 1.
+        base = torch.stack([xs.unsqueeze(1).expand(bs, ws, ws),
+                            ys.unsqueeze(2).expand(bs, ws, ws),
+                            torch.ones(bs, ws, ws, device=device)], 3)
+        theta = get_affine_theta(st_pose, True, device)
+        grid = torch.matmul(base.view(bs, ws * ws, 3), theta.transpose(1, 2))
+
+        # Convert agent view coordinates to coordinates in pred, which is
+        # placed at rows y1:y1+vr and columns x1:x1+vr of the agent view
+        x1 = size // 2 - vr // 2
+        y1 = size // 2
+        grid[:, :, 0] = ((grid[:, :, 0] + 1.) * size - 2. * x1) / vr - 1.
+        grid[:, :, 1] = ((grid[:, :, 1] + 1.) * size - 2. * y1) / vr - 1.
+        warped = F.grid_sample(pred, grid.view(bs, ws, ws, 2))
+
+        b_idx = torch.arange(bs, device=device).view(bs, 1, 1)
+        index = (b_idx, rows.unsqueeze(2), cols.unsqueeze(1))
+        maps[index] = torch.max(maps[index], warped[:, 0])
+        explored[index] = torch.max(explored[index], warped[:, 1])
+        return maps, explored
+
+    def forward(self, obs_last, obs, poses, maps, explored, current_poses,
+            build_maps=True):
+
+        # Get egocentric map prediction for the current obs
+        bs = poses.shape[0]
+        pred = self.get_egocentric_pred(obs)
 
         proj_pred = pred[:, :1, :, :]
         fp_exp_pred = pred[:, 1:, :, :]
 
         with torch.no_grad():
-            # Get egocentric map prediction for the last obs
-            _, c, h, w = obs_last.size()
-            bs = poses.shape[0]
-            resnet_output = self.resnet_l5(obs_last[:, :3, :, :])
-            conv_output = self.conv(resnet_output)
-
-            proj1 = nn.ReLU()(self.proj1(
-                              conv_output.view(-1, self.conv_output_size)))
-            if self.dropout > 0:
-                proj1 = self.dropout1(proj1)
-            proj3 = nn.ReLU()(self.proj2(proj1))
-
-            deconv_input = proj3.view(bs, 64, 8, 8)
-            deconv_output = self.deconv(deconv_input)
-            pred_last = torch.sigmoid(deconv_output)
+            # Get egocentric map prediction for the last obs. It is encoded
+            # separately from obs: a joint pass would change the batch norm
+            # statistics seen in training and backpropagate through the
+            # doubled batch
+            if build_maps and self._use_pred_cache(bs):
+                pred_last = self._get_cached_pred_last(obs_last)
+            else:
+                pred_last = self.get_egocentric_pred(obs_last)
 
             # ST of proj
             vr = self.vision_range
@@ -208,15 +296,19 @@ class Neural_SLAM_Module(nn.Module):
             st_poses[:, 0] = poses[:, 1] * 200. / self.resolution / grid_size
             st_poses[:, 1] = poses[:, 0] * 200. / self.resolution / grid_size
             st_poses[:, 2] = poses[:, 2] * 57.29577951308232
-            rot_mat, trans_mat = get_grid(st_poses,
-                                          (bs, 2, grid_size, grid_size),
-                                          self.device)
-
             grid_map.fill_(0.)
             grid_map[:, :, vr:, int(vr / 2):int(vr / 2 + vr)] = pred_last
-            translated = F.grid_sample(grid_map, trans_mat) # translated = F.grid_sample(grid_map, trans_mat, align_corners=True)
-            rotated = F.grid_sample(translated, rot_mat) # rotated = F.grid_sample(translated, rot_mat, align_corners=True)
-            rotated = rotated[:, :, vr:, int(vr / 2):int(vr / 2 + vr)]
+            if self.fused_warp:
+                rotated = warp_affine(grid_map, st_poses, rotate_first=False,
+                                      window=(vr, grid_size, int(vr / 2),
+                                              int(vr / 2 + vr)))
+            else:
+                rot_mat, trans_mat = get_grid(st_poses,
+                                              (bs, 2, grid_size, grid_size),
+                                              self.device)
+                translated = F.grid_sample(grid_map, trans_mat) # translated = F.grid_sample(grid_map, trans_mat, align_corners=True)
+                rotated = F.grid_sample(translated, rot_mat) # rotated = F.grid_sample(translated, rot_mat, align_corners=True)
+                rotated = rotated[:, :, vr:, int(vr / 2):int(vr / 2 + vr)]
 
             pred_last_st = rotated
 
@@ -249,16 +341,6 @@ class Neural_SLAM_Module(nn.Module):
             # Aggregate egocentric map prediction in the geocentric map
             # using the predicted pose
             with torch.no_grad():
-                agent_view = self.agent_view.detach_()
-                agent_view.fill_(0.)
-
-                x1 = self.map_size_cm // (self.resolution * 2) \
-                        - self.vision_range // 2
-                x2 = x1 + self.vision_range
-                y1 = self.map_size_cm // (self.resolution * 2)
-                y2 = y1 + self.vision_range
-                agent_view[:, :, y1:y2, x1:x2] = pred
-
                 corrected_pose = poses + pose_pred
 
                 def get_new_pose_batch(pose, rel_pose_change):
@@ -287,19 +369,42 @@ class Neural_SLAM_Module(nn.Module):
                                  / (self.map_size_cm // (self.resolution * 2))
                 st_pose[:, 2] = 90. - (st_pose[:, 2])
 
-                rot_mat, trans_mat = get_grid(st_pose, agent_view.size(),
-                                              self.device)
-
-                rotated = F.grid_sample(agent_view, rot_mat) # rotated = F.grid_sample(agent_view, rot_mat, align_corners=True)
-                translated = F.grid_sample(rotated, trans_mat) # translated = F.grid_sample(rotated, trans_mat, align_corners=True)
-
-                maps2 = torch.cat((maps.unsqueeze(1),
-                                   translated[:, :1, :, :]), 1)
-                explored2 = torch.cat((explored.unsqueeze(1),
-                                       translated[:, 1:, :, :]), 1)
-
-                map_pred = self.pool(maps2).squeeze(1)
-                exp_pred = self.pool(explored2).squeeze(1)
+                if self.aggregation_window is not None:
+                    map_pred, exp_pred = self._aggregate_in_window(
+                        pred, st_pose, current_poses, maps, explored)
+                else:
+                    agent_view = self.agent_view.detach_()
+                    agent_view.fill_(0.)
+
+                    x1 = self.map_size_cm // (self.resolution * 2) \
+                            - self.vision_range // 2
+                    x2 = x1 + self.vision_range
+                    y1 = self.map_size_cm // (self.resolution * 2)
+                    y2 = y1 + self.vision_range
+                    agent_view[:, :, y1:y2, x1:x2] = pred
+
+                    if self.fused_warp:
+                        translated = warp_affine(agent_view, st_pose,
+                                                 rotate_first=True)
+                    else:
+                        rot_mat, trans_mat = get_grid(st_pose,
+                                                      agent_view.size(),
+                                                      self.device)
+
+                        rotated = F.grid_sample(agent_view, rot_mat) # rotated = F.grid_sample(agent_view, rot_mat, align_corners=True)
+                        translated = F.grid_sample(rotated, trans_mat) # translated = F.grid_sample(rotated, trans_mat, align_corners=True)
+
+                    maps2 = torch.cat((maps.unsqueeze(1),
+                                       translated[:, :1, :, :]), 1)
+                    explored2 = torch.cat((explored.unsqueeze(1),
+                                           translated[:, 1:, :, :]), 1)
+
+                    map_pred = self.pool(maps2).squeeze(1)
+                    exp_pred = self.pool(explored2).squeeze(1)
+
+                if self._use_pred_cache(bs):
+                    self.pred_cache = pred.detach()
+                    self.pred_cache_valid[:] = True
 
         else:
             map_pred = None
@@ -0,0 +1,74 @@
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from utils.storage import RolloutStorage
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_steps', type=int, default=40)
+parser.add_argument('--num_processes', type=str, default='4,16,72')
+parser.add_argument('--num_runs', type=int, default=200)
+parser.add_argument('--gamma', type=float, default=0.99)
+parser.add_argument('--tau', type=float, default=0.95)
+parser.add_argument('--no_cuda', action='store_true', default=False)
+parser.add_argument('--seed', type=int, default=1)
+
+args = parser.parse_args()
+args.cuda = not args.no_cuda and torch.cuda.is_available()
+device = torch.device("cuda:0" if args.cuda else "cpu")
+
+
+def sync():
+    if args.cuda:
+        torch.cuda.synchronize()
+
+
+def run(fn, rollouts, next_value, use_gae):
+    for _ in range(5):
+        fn(rollouts, next_value, use_gae, args.gamma, args.tau)
+    sync()
+    start = time.time()
+    for _ in range(args.num_runs):
+        fn(rollouts, next_value, use_gae, args.gamma, args.tau)
+    sync()
+    return (time.time() - start) / args.num_runs * 1000., \
+        rollouts.returns.clone()
+
+
+def compute_returns_loop(rollouts, next_value, use_gae, gamma, tau):
+    rollouts.compute_returns(next_value, use_gae, gamma, tau)
+
+
+def compute_returns_vectorized(rollouts, next_value, use_gae, gamma, tau):
+    rollouts.compute_returns(next_value, use_gae, gamma, tau,
+                             vectorized=True)
+
+
+torch.manual_seed(args.seed)
+# RolloutStorage only needs the shape of continuous action spaces
+action_space = argparse.Namespace(shape=(2,))
+
+print("num_processes  use_gae  loop (ms)  vectorized (ms)  speedup  "
+      "max rel diff")
+for num_processes in [int(x) for x in args.num_processes.split(',')]:
+    rollouts = RolloutStorage(args.num_steps, num_processes, (1,),
+                              action_space, 1, device)
+    rollouts.rewards.uniform_(-1., 1.)
+    rollouts.value_preds.uniform_(-5., 5.)
+    # Episode ends at random steps
+    rollouts.masks.copy_((torch.rand_like(rollouts.masks) > 0.05).float())
+    next_value = torch.randn(num_processes, device=device)
+
+    for use_gae in [False, True]:
+        t_loop, ret_loop = run(compute_returns_loop, rollouts, next_value,
+                               use_gae)
+        t_vec, ret_vec = run(compute_returns_vectorized, rollouts,
+                             next_value, use_gae)
+        diff = ((ret_loop - ret_vec).abs() /
+                ret_loop.abs().clamp(min=1.)).max().item()
+        print("{:13d}  {:7d}  {:9.3f}  {:15.3f}  {:6.2f}x  {:.2e}".format(
+            num_processes, use_gae, t_loop, t_vec, t_loop / t_vec, diff))
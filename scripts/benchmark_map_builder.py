@@ -0,0 +1,66 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from env.utils.map_builder import MapBuilder
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--map_sizes_cm', type=str, default='1200,2400,4800')
+parser.add_argument('--num_steps', type=int, default=200)
+parser.add_argument('--frame_size', type=int, default=256)
+parser.add_argument('--seed', type=int, default=1)
+
+args = parser.parse_args()
+
+
+def get_params(map_size_cm, incremental):
+    params = {}
+    params['frame_width'] = args.frame_size
+    params['frame_height'] = args.frame_size
+    params['fov'] = 90.
+    params['resolution'] = 5
+    params['map_size_cm'] = map_size_cm
+    params['agent_min_z'] = 25
+    params['agent_max_z'] = 150
+    params['agent_height'] = 125.
+    params['agent_view_angle'] = 0
+    params['du_scale'] = 2
+    params['vision_range'] = 64
+    params['visualize'] = 0
+    params['obs_threshold'] = 1
+    params['incremental'] = incremental
+    return params
+
+
+def run(map_size_cm, incremental, depths, poses):
+    mapper = MapBuilder(get_params(map_size_cm, incremental))
+    start = time.time()
+    for depth, pose in zip(depths, poses):
+        outputs = mapper.update_map(depth.copy(), pose)
+    elapsed = (time.time() - start) / len(depths)
+    return elapsed, outputs
+
+
+rng = np.random.RandomState(args.seed)
+depths = rng.uniform(50., 500., (args.num_steps, args.frame_size,
+                                 args.frame_size))
+
+print("map_size_cm  full (ms/step)  incremental (ms/step)  speedup")
+for map_size_cm in [int(x) for x in args.map_sizes_cm.split(',')]:
+    center = map_size_cm / 2.
+    poses = [(center + rng.uniform(-200., 200.),
+              center + rng.uniform(-200., 200.),
+              rng.uniform(-np.pi, np.pi)) for _ in range(args.num_steps)]
+
+    t_full, out_full = run(map_size_cm, 0, depths, poses)
+    t_inc, out_inc = run(map_size_cm, 1, depths, poses)
+
+    for x, y in zip(out_full, out_inc):
+        assert np.array_equal(x, y), "Incremental map differs from full map"
+
+    print("{:11d}  {:14.3f}  {:21.3f}  {:7.2f}x".format(
+        map_size_cm, t_full * 1000., t_inc * 1000., t_full / t_inc))
@@ -0,0 +1,271 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+class MapManager():
+    """
+    Keeps the full and local maps of all envs with their local map
+    boundaries, origins and full poses as batched device tensors, so that
+    the per-step map bookkeeping runs as a few tensor ops instead of a
+    loop over envs.
+
+    The full maps are also kept max-pooled by global_downscaling, as used
+    for the global policy input. Between two global steps only the local
+    map windows change, so the team maps and the pooled maps are only
+    updated inside the bounding box of the windows.
+
+    Maps have the channels (obstacles, explored, current location,
+    visited) and the full map has the team's current locations as 5th
+    channel. Poses are (x, y, o) in meters and degrees, boundaries are
+    [gx1, gx2, gy1, gy2] in full map cells.
+    """
+
+    def __init__(self, args, num_scenes, device):
+        self.num_scenes = num_scenes
+        self.device = device
+        self.map_size_cm = args.map_size_cm
+        self.map_resolution = args.map_resolution
+        self.global_downscaling = args.global_downscaling
+
+        map_size = args.map_size_cm // args.map_resolution
+        self.full_w, self.full_h = map_size, map_size
+        self.local_w, self.local_h = int(self.full_w / args.global_downscaling), \
+            int(self.full_h / args.global_downscaling)
+
+        self.full_map = torch.zeros(num_scenes, 5, self.full_w, self.full_h,
+                                    dtype=torch.float32, device=device)
+        self.local_map = torch.zeros(num_scenes, 4, self.local_w, self.local_h,
+                                     dtype=torch.float32, device=device)
+        self.full_pose = torch.zeros(num_scenes, 3, dtype=torch.float32,
+                                     device=device)
+        self.pooled_w = self.full_w // args.global_downscaling
+        self.pooled_h = self.full_h // args.global_downscaling
+        self.pooled_map = torch.zeros(num_scenes, 5, self.pooled_w,
+                                      self.pooled_h, dtype=torch.float32,
+                                      device=device)
+
+        # Local map boundaries and origins, on the device and on the host
+        # for the planner inputs
+        self.lmb = torch.zeros(num_scenes, 4, dtype=torch.long, device=device)
+        self.origins = torch.zeros(num_scenes, 3, dtype=torch.float32,
+                                   device=device)
+        self.lmb_cpu = np.zeros((num_scenes, 4), dtype=int)
+        self.origins_cpu = np.zeros((num_scenes, 3))
+
+        ### Planner pose inputs has 7 dimensions
+        ### 1-3 store continuous global agent location
+        ### 4-7 store local map boundaries
+        self.planner_pose_inputs = np.zeros((num_scenes, 7))
+
+        self._host_maps = None
+        self._host_maps_event = None
+
+        self._envs = torch.arange(num_scenes, device=device).view(-1, 1, 1, 1)
+        self._channels = torch.arange(4, device=device).view(1, -1, 1, 1)
+        self._local_rows = torch.arange(self.local_w, device=device)
+        self._local_cols = torch.arange(self.local_h, device=device)
+
+    def get_cells(self, pose):
+        """Returns the (row, col) map cells of poses as a LongTensor(N, 2)."""
+        # In double precision, as the numpy conversion of the poses did
+        r, c = pose[:, 1].double(), pose[:, 0].double()
+        return torch.stack([(r * 100.0 / self.map_resolution).long(),
+                            (c * 100.0 / self.map_resolution).long()], 1)
+
+    def get_local_map_boundaries(self, cells):
+        """
+        Returns the boundaries of local maps centered at cells, shifted to
+        lie inside the full map. Without global downscaling the local map
+        is the full map and the boundaries are always the full map.
+        """
+        gx1 = (cells[:, 0] - self.local_w // 2).clamp(
+            0, self.full_w - self.local_w)
+        gy1 = (cells[:, 1] - self.local_h // 2).clamp(
+            0, self.full_h - self.local_h)
+        return torch.stack([gx1, gx1 + self.local_w,
+                            gy1, gy1 + self.local_h], 1)
+
+    def get_orientation(self, pose):
+        """Returns the orientation bins used as global policy extras."""
+        return ((pose[:, 2:] + 180.0) / 5.).long()
+
+    def _set_boundaries(self, lmb):
+        self.lmb = lmb
+        self.lmb_cpu = lmb.cpu().numpy()
+        self.origins_cpu = np.stack(
+            [self.lmb_cpu[:, 2] * self.map_resolution / 100.0,
+             self.lmb_cpu[:, 0] * self.map_resolution / 100.0,
+             np.zeros(self.num_scenes)], 1)
+        self.origins = torch.from_numpy(self.origins_cpu).float().to(
+            self.device)
+        self.planner_pose_inputs[:, 3:] = self.lmb_cpu
+
+    def _get_window_index(self):
+        # Indices of the local map windows in the full map, broadcasting to
+        # (N, 4, local_w, local_h)
+        rows = self.lmb[:, 0:1] + self._local_rows
+        cols = self.lmb[:, 2:3] + self._local_cols
+        return self._envs, self._channels, \
+            rows.view(self.num_scenes, 1, -1, 1), \
+            cols.view(self.num_scenes, 1, 1, -1)
+
+    def _read_windows(self):
+        # One gather on the GPU. On the CPU the per-env slice copies are
+        # plain memory copies and faster than indexing every cell.
+        if self.full_map.is_cuda:
+            self.local_map.copy_(self.full_map[self._get_window_index()])
+        else:
+            lmb = self.lmb_cpu
+            for e in range(self.num_scenes):
+                self.local_map[e] = self.full_map[e, :4, lmb[e, 0]:lmb[e, 1],
+                                                  lmb[e, 2]:lmb[e, 3]]
+
+    def _write_windows(self):
+        if self.full_map.is_cuda:
+            self.full_map.index_put_(self._get_window_index(), self.local_map)
+        else:
+            lmb = self.lmb_cpu
+            for e in range(self.num_scenes):
+                self.full_map[e, :4, lmb[e, 0]:lmb[e, 1],
+                              lmb[e, 2]:lmb[e, 3]] = self.local_map[e]
+
+    def _stamp_location(self, maps, cells, radius, clear):
+        """
+        Sets the cells within radius of the agents to 1 in the current
+        location and visited channels of maps, clipped to the map.
+        """
+        num_scenes, sizes = maps.size(0), maps.new_tensor(
+            maps.shape[2:], dtype=torch.long)
+        lower = (cells - radius).clamp(min=0)
+        upper = torch.min(cells + radius + 1, sizes)
+
+        # Indices of a (2 * radius + 1)^2 square per agent. Indices past the
+        # clipped square are moved to its last row or column, so that every
+        # write lands inside the square.
+        offsets = torch.arange(2 * radius + 1, device=maps.device)
+        index = torch.min(lower.unsqueeze(2) + offsets, upper.unsqueeze(2) - 1)
+        index = torch.min(index.clamp(min=0), sizes.view(1, 2, 1) - 1)
+        index = (index[:, 0].unsqueeze(2) * maps.size(3) +
+                 index[:, 1].unsqueeze(1)).view(num_scenes, -1)
+
+        # Agents outside the map write back the values they read
+        outside = (upper <= lower).any(1).view(-1, 1)
+
+        if clear:
+            maps[:, 2].fill_(0.)
+        for channel in [2, 3]:
+            flat = maps[:, channel].view(num_scenes, -1)
+            values = torch.where(outside, flat.gather(1, index),
+                                 torch.ones_like(index, dtype=maps.dtype))
+            flat.scatter_(1, index, values)
+
+    def _get_dirty_box(self):
+        # Bounding box [x1, x2, y1, y2] of the current local map windows
+        lmb = self.lmb_cpu
+        return [lmb[:, 0].min(), lmb[:, 1].max(),
+                lmb[:, 2].min(), lmb[:, 3].max()]
+
+    def _merge_team_maps(self, box):
+        # All agents in a scene share the obstacle and explored maps and
+        # see each other's current locations. Outside the box the full
+        # maps of all agents are already merged.
+        x1, x2, y1, y2 = box
+        window = self.full_map[:, :, x1:x2, y1:y2]
+        window[:, 0] = torch.max(window[:, 0], dim=0).values
+        window[:, 1] = torch.max(window[:, 1], dim=0).values
+        window[:, 4] = torch.max(window[:, 2], dim=0).values
+
+    def _update_pooled_map(self, box):
+        # Recomputes the pooled cells overlapping the box, the team channels
+        # are the same for all agents and are pooled once
+        x1, x2, y1, y2 = box
+        gd = self.global_downscaling
+        px1, px2 = x1 // gd, min(-(-x2 // gd), self.pooled_w)
+        py1, py2 = y1 // gd, min(-(-y2 // gd), self.pooled_h)
+
+        window = self.full_map[:, :, px1 * gd:px2 * gd, py1 * gd:py2 * gd]
+        pooled = self.pooled_map[:, :, px1:px2, py1:py2]
+        pooled[:, 2:4] = F.max_pool2d(window[:, 2:4], gd)
+        team = F.max_pool2d(window[0, [0, 1, 4]], gd)
+        pooled[:, 0:2] = team[0:2]
+        pooled[:, 4] = team[2]
+
+    def reset(self):
+        """
+        Clears the maps and puts every agent at the center of its full
+        map. Returns the local poses.
+        """
+        self.full_map.fill_(0.)
+        self.full_pose.fill_(0.)
+        self.full_pose[:, :2] = self.map_size_cm / 100.0 / 2.0
+        self.planner_pose_inputs[:, :3] = self.full_pose.cpu().numpy()
+
+        cells = self.get_cells(self.full_pose)
+        self._stamp_location(self.full_map, cells, 1, False)
+        self._set_boundaries(self.get_local_map_boundaries(cells))
+
+        box = [0, self.full_w, 0, self.full_h]
+        self._merge_team_maps(box)
+        self._update_pooled_map(box)
+        self._read_windows()
+        return self.full_pose - self.origins
+
+    def stamp_location(self, local_pose, radius, clear=True):
+        """
+        Marks the agent locations in the local maps, clearing the previous
+        current locations if clear.
+        """
+        self._stamp_location(self.local_map, self.get_cells(local_pose),
+                             radius, clear)
+
+    def get_planner_maps(self):
+        """
+        Returns the obstacle and explored channels of the local maps as a
+        numpy array (N, 2, local_w, local_h) for the planner inputs. GPU maps
+        are copied without blocking in one transfer to a pinned buffer,
+        which is reused by the next call. The array must not be read before
+        wait_planner_maps() returns.
+        """
+        if not self.local_map.is_cuda:
+            return self.local_map[:, :2].numpy()
+
+        if self._host_maps is None:
+            self._host_maps = torch.empty(self.local_map[:, :2].shape,
+                                          dtype=self.local_map.dtype,
+                                          pin_memory=True)
+        self._host_maps.copy_(self.local_map[:, :2], non_blocking=True)
+        self._host_maps_event = torch.cuda.Event()
+        self._host_maps_event.record(
+            torch.cuda.current_stream(self.local_map.device))
+        return self._host_maps.numpy()
+
+    def wait_planner_maps(self):
+        """Waits for the copy of the last get_planner_maps call."""
+        if self._host_maps_event is not None:
+            self._host_maps_event.synchronize()
+            self._host_maps_event = None
+
+    def update_planner_pose(self, local_pose):
+        """Updates the global agent locations of the planner pose inputs."""
+        locs = local_pose.cpu().numpy()
+        self.planner_pose_inputs[:, :3] = locs + self.origins_cpu
+        return locs
+
+    def update_global(self, local_pose):
+        """
+        Writes the local maps back to the full maps, merges the team maps
+        and updates the pooled maps, then recenters the local maps on the
+        agents. Returns the new local poses.
+        """
+        self._write_windows()
+        self.full_pose = local_pose + self.origins
+        box = self._get_dirty_box()
+
+        self._set_boundaries(self.get_local_map_boundaries(
+            self.get_cells(self.full_pose)))
+
+        self._merge_team_maps(box)
+        self._update_pooled_map(box)
+        self._read_windows()
+        return self.full_pose - self.origins
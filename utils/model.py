@@ -46,6 +46,85 @@ def get_grid(pose, grid_size, device):
     return rot_grid, trans_grid
 
 
+def get_affine_theta(pose, rotate_first, device):
+    """
+    Returns the single affine transform equivalent to sampling with the
+    two grids of get_grid one after the other.
+    Input:
+        `pose` FloatTensor(bs, 3)
+        `rotate_first` bool, True to compose sampling with `rot_grid` and
+            then `trans_grid`, False for `trans_grid` and then `rot_grid`
+        `device` torch.device (cpu or gpu)
+    Output:
+        `theta` FloatTensor(bs, 2, 3)
+    """
+    pose = pose.float().to(device)
+    t = pose[:, 2] * np.pi / 180.
+    cos_t = t.cos()
+    sin_t = t.sin()
+
+    rot = torch.stack([torch.stack([cos_t, -sin_t], 1),
+                       torch.stack([sin_t, cos_t], 1)], 1)
+    trans = pose[:, :2].unsqueeze(2)
+    if rotate_first:
+        # out(p) = rotated(p + t) = in(R (p + t))
+        trans = torch.bmm(rot, trans)
+    # else out(p) = translated(R p) = in(R p + t)
+    return torch.cat([rot, trans], 2)
+
+
+_base_grids = {}
+
+
+def _get_base_grid(grid_h, grid_w, device):
+    """Returns the cached identity sampling grid in homogeneous coords."""
+    key = (grid_h, grid_w, str(device))
+    if key not in _base_grids:
+        identity = torch.tensor([[[1., 0., 0.], [0., 1., 0.]]],
+                                device=device)
+        base = F.affine_grid(identity, torch.Size((1, 1, grid_h, grid_w)))
+        ones = torch.ones(grid_h, grid_w, 1, device=device)
+        _base_grids[key] = torch.cat([base[0], ones], 2)
+    return _base_grids[key]
+
+
+def get_affine_grid(theta, grid_size, window=None):
+    """
+    Same as F.affine_grid but reuses a cached base grid, and optionally
+    only computes the grid of the output window (y1, y2, x1, x2).
+    Input:
+        `theta` FloatTensor(bs, 2, 3)
+        `grid_size` 4-tuple (bs, _, grid_h, grid_w)
+        `window` 4-tuple (y1, y2, x1, x2) or None
+    Output:
+        `grid` FloatTensor(bs, y2 - y1, x2 - x1, 2)
+    """
+    base = _get_base_grid(grid_size[2], grid_size[3], theta.device)
+    if window is not None:
+        y1, y2, x1, x2 = window
+        base = base[y1:y2, x1:x2]
+    h, w = base.shape[:2]
+    grid = torch.matmul(base.reshape(1, h * w, 3), theta.transpose(1, 2))
+    return grid.view(theta.shape[0], h, w, 2)
+
+
+def warp_affine(x, pose, rotate_first, window=None):
+    """
+    Warps x with the rotation and translation of get_grid in a single
+    grid_sample instead of two.
+    Input:
+        `x` FloatTensor(bs, c, h, w)
+        `pose` FloatTensor(bs, 3), same convention as get_grid
+        `rotate_first` bool, see get_affine_theta
+        `window` 4-tuple (y1, y2, x1, x2) of the output to compute, or None
+    Output:
+        FloatTensor(bs, c, h, w), or (bs, c, y2 - y1, x2 - x1) with window
+    """
+    theta = get_affine_theta(pose, rotate_first, x.device)
+    grid = get_affine_grid(theta, x.size(), window)
+    return F.grid_sample(x, grid)
+
+
 class ChannelPool(nn.MaxPool1d):
     def forward(self, x):
         n, c, w, h = x.size()
@@ -0,0 +1,31 @@
+import torch
+
+
+def calc_rewards(current_explored_area, previously_explored_area,
+                 changed_cells=None):
+    """
+    current_explored_area: tensor of size[num_agents, <dimensions of explored area>]
+    previously_explored_area: tensor of size[<dimensions of explored area>]
+    changed_cells: optional LongTensor of flat indices of the cells explored
+        since the previous call, only these cells can earn the new-area reward
+
+    An agent earns 10 for each cell it explored that no other agent has
+    explored and that was not explored before, and 0.01 for each cell it
+    explored, scaled by 0.0005. The explored areas are binary maps.
+    """
+    num_agents = current_explored_area.size(0)
+    current = current_explored_area.view(num_agents, -1) > 0.5
+    previous = previously_explored_area.view(-1) > 0.5
+    num_explored = current.sum(1)
+
+    if changed_cells is not None:
+        current = current[:, changed_cells]
+        previous = previous[changed_cells]
+
+    # Cells explored by exactly one agent (the team sum is computed once)
+    exclusive = current.sum(0, dtype=torch.int32) == 1
+    new_cells = current & (exclusive & ~previous).unsqueeze(0)
+    num_new = new_cells.sum(1)
+
+    rewards = (num_new * 10. + num_explored * 0.01) * 0.0005 # actually 0.0005 but I modified it
+    return rewards
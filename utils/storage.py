@@ -1,6 +1,13 @@
 # The following code is largely borrowed from:
 # https://github.com/ikostrikov/pytorch-a2c-ppo-acktr-gail/blob/master/a2c_ppo_acktr/storage.py
 
+import json
+import mmap
+import os
+import queue
+import threading
+import time
+import warnings
 from collections import namedtuple
 # from multiprocessing import Pool
 
@@ -13,6 +20,31 @@ def _flatten_helper(T, N, _tensor):
     return _tensor.view(T * N, *_tensor.size()[2:])
 
 
+def _discounted_cumsum(x, discounts, last=None):
+    """
+    Computes out[t] = x[t] + discounts[t] * out[t + 1] for all steps at
+    once, with out[T] = last (or 0), as out = D x where
+    D[t, k] = prod(discounts[t:k]) for k >= t and 0 otherwise.
+    Input:
+        `x`, `discounts` FloatTensor(T, N)
+        `last` FloatTensor(N) or None
+    Output:
+        FloatTensor(T, N)
+    """
+    T = x.size(0)
+    upper = torch.ones(T, T, dtype=torch.bool, device=x.device).triu()
+    # cumprod[t, j] = prod(discounts[t:j + 1]) for j >= t
+    factors = torch.where(upper.unsqueeze(2), discounts.unsqueeze(0),
+                          torch.ones_like(discounts).unsqueeze(0))
+    cumprod = factors.cumprod(1)
+    weights = torch.cat([torch.ones_like(cumprod[:, :1]),
+                         cumprod[:, :-1]], 1) * upper.unsqueeze(2)
+    out = (weights * x.unsqueeze(0)).sum(1)
+    if last is not None:
+        out = out + cumprod[:, -1] * last
+    return out
+
+
 class RolloutStorage(object):
 
     def __init__(self, num_steps, num_processes, obs_shape, action_space,
@@ -73,8 +105,16 @@ class RolloutStorage(object):
         if self.has_extras:
             self.extras[0].copy_(self.extras[-1])
 
-    def compute_returns(self, next_value, use_gae, gamma, tau):
-        if use_gae:
+    def compute_returns(self, next_value, use_gae, gamma, tau,
+                        vectorized=False):
+        """
+        Computes the returns backwards step by step. With vectorized, all
+        steps are computed at once with _discounted_cumsum, which only
+        differs from the loop in summation order.
+        """
+        if vectorized:
+            self._compute_returns_vectorized(next_value, use_gae, gamma, tau)
+        elif use_gae:
             self.value_preds[-1] = next_value
             gae = 0
             for step in reversed(range(self.rewards.size(0))):
@@ -89,6 +129,18 @@ class RolloutStorage(object):
                 self.returns[step] = self.returns[step + 1] * gamma \
                                      * self.masks[step + 1] + self.rewards[step]
 
+    def _compute_returns_vectorized(self, next_value, use_gae, gamma, tau):
+        if use_gae:
+            self.value_preds[-1] = next_value
+            delta = self.rewards + gamma * self.value_preds[1:] \
+                    * self.masks[1:] - self.value_preds[:-1]
+            gae = _discounted_cumsum(delta, gamma * tau * self.masks[1:])
+            self.returns[:-1] = gae + self.value_preds[:-1]
+        else:
+            self.returns[-1] = next_value
+            self.returns[:-1] = _discounted_cumsum(
+                self.rewards, gamma * self.masks[1:], self.returns[-1])
+
     def feed_forward_generator(self, advantages, num_mini_batch):
 
         num_steps, num_processes = self.rewards.size()[0:2]
@@ -127,57 +179,25 @@ class RolloutStorage(object):
             "to be greater than or equal to the number of "
             "PPO mini batches ({}).".format(num_processes, num_mini_batch))
         num_envs_per_batch = num_processes // num_mini_batch
-        perm = torch.randperm(num_processes)
+        perm = torch.randperm(num_processes).to(self.obs.device)
         T, N = self.num_steps, num_envs_per_batch
 
         for start_ind in range(0, num_processes, num_envs_per_batch):
-
-            obs = []
-            rec_states = []
-            actions = []
-            value_preds = []
-            returns = []
-            masks = []
-            old_action_log_probs = []
-            adv_targ = []
-            if self.has_extras:
-                extras = []
-
-            for offset in range(num_envs_per_batch):
-
-                ind = perm[start_ind + offset]
-                obs.append(self.obs[:-1, ind])
-                rec_states.append(self.rec_states[0:1, ind])
-                actions.append(self.actions[:, ind])
-                value_preds.append(self.value_preds[:-1, ind])
-                returns.append(self.returns[:-1, ind])
-                masks.append(self.masks[:-1, ind])
-                old_action_log_probs.append(self.action_log_probs[:, ind])
-                adv_targ.append(advantages[:, ind])
-                if self.has_extras:
-                    extras.append(self.extras[:-1, ind])
-
-            # These are all tensors of size (T, N, ...)
-            obs = torch.stack(obs, 1)
-            actions = torch.stack(actions, 1)
-            value_preds = torch.stack(value_preds, 1)
-            returns = torch.stack(returns, 1)
-            masks = torch.stack(masks, 1)
-            old_action_log_probs = torch.stack(old_action_log_probs, 1)
-            adv_targ = torch.stack(adv_targ, 1)
-            if self.has_extras:
-                extras = torch.stack(extras, 1)
+            # One gather per field, giving tensors of size (T, N, ...)
+            inds = perm[start_ind:start_ind + num_envs_per_batch]
 
             yield {
-                'obs': _flatten_helper(T, N, obs),
-                'actions': _flatten_helper(T, N, actions),
-                'value_preds': _flatten_helper(T, N, value_preds),
-                'returns': _flatten_helper(T, N, returns),
-                'masks': _flatten_helper(T, N, masks),
-                'old_action_log_probs': _flatten_helper(T, N, old_action_log_probs),
-                'adv_targ': _flatten_helper(T, N, adv_targ),
-                'extras': _flatten_helper(T, N, extras) if self.has_extras else None,
-                'rec_states': torch.stack(rec_states, 1).view(N, -1),
+                'obs': _flatten_helper(T, N, self.obs[:-1, inds]),
+                'actions': _flatten_helper(T, N, self.actions[:, inds]),
+                'value_preds': _flatten_helper(T, N, self.value_preds[:-1, inds]),
+                'returns': _flatten_helper(T, N, self.returns[:-1, inds]),
+                'masks': _flatten_helper(T, N, self.masks[:-1, inds]),
+                'old_action_log_probs': _flatten_helper(
+                    T, N, self.action_log_probs[:, inds]),
+                'adv_targ': _flatten_helper(T, N, advantages[:, inds]),
+                'extras': _flatten_helper(T, N, self.extras[:-1, inds]) \
+                    if self.has_extras else None,
+                'rec_states': self.rec_states[0, inds].view(N, -1),
             }
 
 
@@ -203,84 +223,527 @@ Datapoint = namedtuple('Datapoint',
                        ('input', 'target'))
 
 
-class FIFOMemory(object):
+def _sample_distinct(n, k):
+    """Samples k distinct integers in [0, n) in random order, k <= n."""
+    if 2 * k > n:
+        return np.random.permutation(n)[:k]
+    # Sampling without replacement by redrawing duplicates, which
+    # avoids the full permutation of np.random.choice
+    indices = np.unique(np.random.randint(n, size=k))
+    while len(indices) < k:
+        extra = np.random.randint(n, size=k - len(indices))
+        indices = np.unique(np.concatenate([indices, extra]))
+    np.random.shuffle(indices)
+    return indices
+
 
-    def __init__(self, capacity):
+class FIFOMemory(object):
+    """
+    Fixed-size FIFO memory of (input, target) datapoints. Every field is
+    stored in one preallocated tensor with its own dtype, created on the
+    first push, and batches are gathered with a single index_select per
+    field into pinned staging buffers.
+    """
+
+    def __init__(self, capacity, in_dtypes=None, out_dtypes=None,
+                 pin_memory=False):
         self.capacity = capacity
-        self.memory = []
+        self.in_dtypes = in_dtypes
+        self.out_dtypes = out_dtypes
+        self.pin_memory = pin_memory
+        self.inputs = None
+        self.outputs = None
+        self.size = 0
         self.position = 0
 
-    def push(self, *args):
-        """Saves a datapoint."""
-        if len(self.memory) < self.capacity:
-            self.memory.append(None)
-
-        self.memory[self.position] = Datapoint(*args)
-        if self.position == 0:
-            x = self.memory[0][0]
-            y = self.memory[0][1]
-            self.batch_in_sizes = {}
-            self.n_inputs = len(x)
-            for dim in range(len(x)):
-                self.batch_in_sizes[dim] = x[dim].size()
-
-            self.batch_out_sizes = {}
-            self.n_outputs = len(y)
-            for dim in range(len(y)):
-                self.batch_out_sizes[dim] = y[dim].size()
-
-        self.position = (self.position + 1) % self.capacity
-
-    def sample(self, batch_size):
-        """Samples a batch"""
-
-        batch = {}
-        inputs = []
-        outputs = []
+        # Two sets of staging buffers per batch size, so that a batch can
+        # be gathered while the copy of the previous one is in flight
+        self.staging = {}
+        self.staging_idx = 0
+
+        # Guards pushes against sampling from a prefetch thread
+        self.lock = threading.Lock()
+
+    def _allocate(self, x, y):
+        self.n_inputs = len(x)
+        self.n_outputs = len(y)
+        self.batch_in_sizes = {dim: x[dim].size() for dim in range(len(x))}
+        self.batch_out_sizes = {dim: y[dim].size() for dim in range(len(y))}
+
+        in_dtypes = self.in_dtypes or [torch.float32] * self.n_inputs
+        out_dtypes = self.out_dtypes or [torch.float32] * self.n_outputs
+        self.inputs = [torch.zeros((self.capacity,) + x[dim].size(),
+                                   dtype=in_dtypes[dim])
+                       for dim in range(self.n_inputs)]
+        self.outputs = [torch.zeros((self.capacity,) + y[dim].size(),
+                                    dtype=out_dtypes[dim])
+                        for dim in range(self.n_outputs)]
+
+    def push(self, *args, stream=None):
+        """Saves a datapoint. stream is only used by CompactSLAMMemory."""
+        with self.lock:
+            self._push(*args, stream=stream)
+
+    def sample(self, batch_size, device=None):
+        """Samples a batch. Fields are returned as float tensors on device."""
+        with self.lock:
+            return self._sample(batch_size, device)
+
+    def _push(self, *args, stream=None):
+        x, y = Datapoint(*args)
+        if self.inputs is None:
+            self._allocate(x, y)
 
         for dim in range(self.n_inputs):
-            inputs.append(torch.cat(batch_size *
-                                    [torch.zeros(
-                                        self.batch_in_sizes[dim]
-                                    ).unsqueeze(0)]))
-
+            self.inputs[dim][self.position].copy_(x[dim])
         for dim in range(self.n_outputs):
-            outputs.append(torch.cat(batch_size *
-                                     [torch.zeros(
-                                         self.batch_out_sizes[dim]
-                                     ).unsqueeze(0)]))
-
-        indices = np.random.choice(len(self.memory), batch_size, replace=False)
-
-        count = 0
-        for i in indices:
-            x = self.memory[i][0]
-            y = self.memory[i][1]
+            self.outputs[dim][self.position].copy_(y[dim])
 
-            for dim in range(len(x)):
-                inputs[dim][count] = x[dim]
+        self.size = min(self.size + 1, self.capacity)
+        self.position = (self.position + 1) % self.capacity
 
-            for dim in range(len(y)):
-                outputs[dim][count] = y[dim]
+    def _sample_indices(self, batch_size):
+        return torch.from_numpy(_sample_distinct(self.size, batch_size))
+
+    def _get_staging(self, batch_size, tensors):
+        key = (batch_size, self.staging_idx)
+        self.staging_idx = 1 - self.staging_idx
+        if key not in self.staging:
+            buffers = [torch.empty((batch_size,) + tuple(t.shape[1:]),
+                                   dtype=t.dtype)
+                       for t in tensors]
+            if self.pin_memory:
+                buffers = [b.pin_memory() for b in buffers]
+            self.staging[key] = [buffers, None]
+        # Wait for the previous copy out of these buffers to finish
+        event = self.staging[key][1]
+        if event is not None:
+            event.synchronize()
+        return self.staging[key]
+
+    def _gather(self, sources, device):
+        """
+        Gathers the rows of each (tensor, indices) source into staging
+        buffers and moves them to device, copying without blocking from
+        pinned memory for cuda devices. Keeps the storage dtypes.
+        """
+        batch_size = len(sources[0][1])
+        staging = self._get_staging(batch_size, [t for t, _ in sources])
+        buffers = staging[0]
+        for (tensor, indices), buffer in zip(sources, buffers):
+            torch.index_select(tensor, 0, indices, out=buffer)
+
+        if device is not None and torch.device(device).type == 'cuda':
+            batch = [b.to(device, non_blocking=self.pin_memory)
+                     for b in buffers]
+            staging[1] = torch.cuda.Event()
+            staging[1].record()
+        else:
+            # Do not alias the staging buffers
+            batch = [b.clone() for b in buffers]
+            if device is not None:
+                batch = [b.to(device) for b in batch]
+        return batch
+
+    def _sample(self, batch_size, device=None):
+        indices = self._sample_indices(batch_size)
+        batch = self._gather([(t, indices)
+                              for t in self.inputs + self.outputs], device)
+        batch = [b.float() for b in batch]
+        return (batch[:self.n_inputs], batch[self.n_inputs:])
 
-            count += 1
+    def __len__(self):
+        return self.size
+
+
+def pack_bits(x):
+    """Packs a binary tensor (N, ...) into uint8 (N, ceil(numel / 8))."""
+    x = x.reshape(x.shape[0], -1)
+    pad = (-x.shape[1]) % 8
+    if pad > 0:
+        x = torch.cat([x, x.new_zeros(x.shape[0], pad)], 1)
+    weights = torch.tensor([128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8,
+                           device=x.device)
+    bits = (x > 0.5).to(torch.uint8).view(x.shape[0], -1, 8)
+    return (bits * weights).sum(2, dtype=torch.uint8)
+
+
+def unpack_bits(packed, shape):
+    """Unpacks the output of pack_bits to a float tensor (N,) + shape."""
+    shifts = torch.arange(7, -1, -1, dtype=torch.uint8, device=packed.device)
+    bits = (packed.unsqueeze(2) >> shifts) & 1
+    numel = int(np.prod(shape))
+    bits = bits.view(packed.shape[0], -1)[:, :numel]
+    return bits.float().view((packed.shape[0],) + tuple(shape))
+
+
+class CompactSLAMMemory(FIFOMemory):
+    """
+    FIFOMemory for the SLAM datapoints ((obs_last, obs, poses),
+    (fp_proj, fp_explored, pose_err)) in a compact format: RGB frames are
+    stored once as uint8 in a frame ring and referenced by id, so that
+    obs_last of a transition reuses obs of the previous transition of the
+    same stream, and the binary projections are bit-packed. Frames and
+    projections are decoded on sample, after the copy to the device.
+    """
+
+    def __init__(self, capacity, frame_slack=None, pin_memory=False):
+        super(CompactSLAMMemory, self).__init__(capacity,
+                                                pin_memory=pin_memory)
+        # Frames are shared between consecutive transitions of a stream,
+        # transitions whose frames have been overwritten are not sampled
+        if frame_slack is None:
+            frame_slack = capacity // 8 + 64
+        self.frame_capacity = capacity + frame_slack
+        self.next_frame_id = 0
+        self.last_frame_ids = {}
+
+    def _allocate(self, x, y):
+        self.n_inputs = len(x)
+        self.n_outputs = len(y)
+        self.frame_shape = x[1].size()
+        self.proj_shapes = [y[0].size(), y[1].size()]
+
+        self.frames = torch.zeros((self.frame_capacity,) + self.frame_shape,
+                                  dtype=torch.uint8)
+        self.frame_ids = torch.zeros((self.capacity, 2), dtype=torch.int64)
+        self.poses = torch.zeros((self.capacity,) + x[2].size())
+        self.packed_projs = [
+            torch.zeros((self.capacity, (int(np.prod(shape)) + 7) // 8),
+                        dtype=torch.uint8) for shape in self.proj_shapes]
+        self.pose_errs = torch.zeros((self.capacity,) + y[2].size())
+        # Marks the storage as allocated
+        self.inputs = [self.frames, self.poses]
+
+    def _push_frame(self, frame, reuse_id=None):
+        # Frames can be pushed from any device, e.g. obs_last on the GPU
+        frame = frame.to('cpu', torch.uint8)
+        if reuse_id is not None and \
+                reuse_id >= self.next_frame_id - self.frame_capacity and \
+                torch.equal(self.frames[reuse_id % self.frame_capacity],
+                            frame):
+            return reuse_id
+        frame_id = self.next_frame_id
+        self.frames[frame_id % self.frame_capacity].copy_(frame)
+        self.next_frame_id += 1
+        return frame_id
+
+    def _push(self, *args, stream=None):
+        # Frames are only deduplicated between datapoints pushed with the
+        # same stream, e.g. the env index
+        x, y = Datapoint(*args)
+        if self.inputs is None:
+            self._allocate(x, y)
+
+        last_id = self._push_frame(x[0], self.last_frame_ids.get(stream))
+        frame_id = self._push_frame(x[1], last_id)
+        if stream is not None:
+            self.last_frame_ids[stream] = frame_id
+
+        self.frame_ids[self.position, 0] = last_id
+        self.frame_ids[self.position, 1] = frame_id
+        self.poses[self.position].copy_(x[2])
+        self.packed_projs[0][self.position] = pack_bits(y[0].unsqueeze(0))[0]
+        self.packed_projs[1][self.position] = pack_bits(y[1].unsqueeze(0))[0]
+        self.pose_errs[self.position].copy_(y[2])
+
+        self.size = min(self.size + 1, self.capacity)
+        self.position = (self.position + 1) % self.capacity
 
+    def _get_valid(self):
+        # Transitions whose frames are still in the frame ring
+        frame_ids = self.frame_ids[:self.size].numpy()
+        return frame_ids[:, 0] >= self.next_frame_id - self.frame_capacity
+
+    def _sample_indices(self, batch_size):
+        # Only valid transitions are sampled, fewer than batch_size if
+        # there are not enough of them
+        valid = np.flatnonzero(self._get_valid())
+        positions = _sample_distinct(len(valid), min(batch_size, len(valid)))
+        return torch.from_numpy(valid[positions])
+
+    def _sample(self, batch_size, device=None):
+        indices = self._sample_indices(batch_size)
+        frame_slots = self.frame_ids[indices] % self.frame_capacity
+        obs_last, obs, poses, proj, exp, pose_err = self._gather([
+            (self.frames, frame_slots[:, 0]),
+            (self.frames, frame_slots[:, 1]),
+            (self.poses, indices),
+            (self.packed_projs[0], indices),
+            (self.packed_projs[1], indices),
+            (self.pose_errs, indices)], device)
+
+        inputs = [obs_last.float(), obs.float(), poses]
+        outputs = [unpack_bits(proj, self.proj_shapes[0]),
+                   unpack_bits(exp, self.proj_shapes[1]), pose_err]
         return (inputs, outputs)
 
-    # def sample_loader(self, batch_size, num_samples, num_processes, device=None):
-    #     with Pool(processes=num_processes) as pool:
-    #         # multiple_results caches the next num_processes results if sampled
-    #         multiple_results = [pool.apply_async(self.sample, (batch_size,)) 
-    #                                 for i in range(num_samples)]
-    #         for res in multiple_results:
-    #             if device is None:
-    #                 yield res.get()
-    #             else:                        
-    #                 inputs, outputs = res.get()
-    #                 inputs = [x.to(device) for x in inputs]
-    #                 outputs = [x.to(device) for x in outputs]
-    #                 yield (inputs, outputs)
-
 
-    def __len__(self):
-        return len(self.memory)
+class MemmapSLAMMemory(CompactSLAMMemory):
+    """
+    CompactSLAMMemory backed by a memory-mapped file, so that the replay
+    can be larger than RAM, survive restarts and be shared between jobs.
+
+    The file starts with a JSON header holding the layout and the state
+    of the memory, followed by the frame ring and the transitions stored
+    as fixed-size records. The frame ids of the transitions are kept in
+    RAM as the index used for sampling. The state in the header is only
+    updated by flush(), a memory opened on an existing file resumes from
+    its last flush. With read_only, the file is opened for sampling only
+    and refresh() reloads the state flushed by the writer.
+    """
+
+    header_size = 4096
+    version = 1
+
+    def __init__(self, capacity, path, frame_slack=None, read_only=False,
+                 pin_memory=False):
+        super(MemmapSLAMMemory, self).__init__(capacity, frame_slack,
+                                               pin_memory=pin_memory)
+        self.path = path
+        self.read_only = read_only
+        self.mmap = None
+        if os.path.exists(path):
+            self._open()
+        elif read_only:
+            raise IOError("Replay file {} does not exist".format(path))
+
+    def _get_record_dtype(self, pose_size, proj_bytes, pose_err_size):
+        fields = [('frame_ids', '<i8', (2,)),
+                  ('poses', '<f4', (pose_size,)),
+                  ('proj', 'u1', (proj_bytes[0],)),
+                  ('exp', 'u1', (proj_bytes[1],)),
+                  ('pose_err', '<f4', (pose_err_size,))]
+        size = np.dtype(fields).itemsize
+        # Pad records to 8 bytes so that every field view stays aligned
+        if size % 8 != 0:
+            fields.append(('pad', 'u1', (8 - size % 8,)))
+        return np.dtype(fields)
+
+    def _read_header(self):
+        with open(self.path, 'rb') as f:
+            return json.loads(f.read(self.header_size).decode('utf-8'))
+
+    def _write_header(self):
+        header = dict(self.layout)
+        header.update({'size': self.size, 'position': self.position,
+                       'next_frame_id': self.next_frame_id})
+        data = json.dumps(header).encode('utf-8')
+        assert len(data) <= self.header_size
+        self.file_array[:len(data)] = np.frombuffer(data, dtype=np.uint8)
+        self.file_array[len(data):self.header_size] = ord(' ')
+
+    def _map(self, layout, mode):
+        self.layout = layout
+        self.frame_shape = torch.Size(layout['frame_shape'])
+        self.proj_shapes = [torch.Size(shape)
+                            for shape in layout['proj_shapes']]
+        self.n_inputs = self.n_outputs = 3
+        frame_bytes = int(np.prod(layout['frame_shape']))
+        record_dtype = self._get_record_dtype(
+            layout['pose_size'], layout['proj_bytes'],
+            layout['pose_err_size'])
+        frames_end = self.header_size + \
+            layout['frame_capacity'] * frame_bytes
+        total = frames_end + layout['capacity'] * record_dtype.itemsize
+
+        self.file_array = np.memmap(self.path, dtype=np.uint8, mode=mode,
+                                    shape=(total,))
+        self.mmap = self.file_array._mmap
+        if hasattr(mmap, 'MADV_RANDOM'):
+            # Sampling is random, the kernel readahead only wastes IO
+            self.mmap.madvise(mmap.MADV_RANDOM)
+        self.frame_bytes = frame_bytes
+        self.frames_offset = self.header_size
+        self.records_offset = frames_end
+        self.record_size = record_dtype.itemsize
+
+        frames = self.file_array[self.header_size:frames_end]
+        records = self.file_array[frames_end:].view(record_dtype)
+        self.records = records
+        with warnings.catch_warnings():
+            # Tensors of read-only files are never written to
+            warnings.simplefilter('ignore', UserWarning)
+            self.frames = torch.from_numpy(frames).view(
+                (layout['frame_capacity'],) + tuple(self.frame_shape))
+            self.poses = torch.from_numpy(records['poses'])
+            self.packed_projs = [torch.from_numpy(records['proj']),
+                                 torch.from_numpy(records['exp'])]
+            self.pose_errs = torch.from_numpy(records['pose_err'])
+        self.inputs = [self.frames, self.poses]
+
+    def _open(self):
+        header = self._read_header()
+        if header['version'] != self.version:
+            raise ValueError("Replay file {} has version {}, expected {}"
+                             .format(self.path, header['version'],
+                                     self.version))
+        if header['capacity'] != self.capacity:
+            raise ValueError("Replay file {} has capacity {}, expected {}"
+                             .format(self.path, header['capacity'],
+                                     self.capacity))
+        self.frame_capacity = header['frame_capacity']
+        layout = {k: v for k, v in header.items()
+                  if k not in ['size', 'position', 'next_frame_id']}
+        self._map(layout, 'r' if self.read_only else 'r+')
+        self._load_state(header)
+
+    def _load_state(self, header):
+        self.size = header['size']
+        self.position = header['position']
+        self.next_frame_id = header['next_frame_id']
+        self.frame_ids = torch.from_numpy(
+            np.array(self.records['frame_ids']))
+        self.last_frame_ids = {}
+
+        # Pushes after the flush may have written records and frames past
+        # next_frame_id, up to two frames of an interrupted push without
+        # their record. Those frames overwrote the oldest frames of the
+        # ring, transitions referencing them are not sampled.
+        newest = max(self.next_frame_id,
+                     int(self.frame_ids[:, 1].max()) + 1) + 2
+        self.min_frame_id = newest - self.frame_capacity
+
+    def refresh(self):
+        """Reloads the state last flushed to the file."""
+        with self.lock:
+            self._load_state(self._read_header())
+
+    def _allocate(self, x, y):
+        proj_bytes = [(int(np.prod(y[i].size())) + 7) // 8 for i in [0, 1]]
+        layout = {'version': self.version,
+                  'capacity': self.capacity,
+                  'frame_capacity': self.frame_capacity,
+                  'frame_shape': list(x[1].size()),
+                  'proj_shapes': [list(y[0].size()), list(y[1].size())],
+                  'proj_bytes': proj_bytes,
+                  'pose_size': int(x[2].numel()),
+                  'pose_err_size': int(y[2].numel())}
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self._map(layout, 'w+')
+        self.frame_ids = torch.zeros((self.capacity, 2), dtype=torch.int64)
+        self.min_frame_id = 0
+        self._write_header()
+
+    def _push(self, *args, stream=None):
+        if self.read_only:
+            raise RuntimeError("Cannot push to a read-only replay file")
+        position = self.position
+        super(MemmapSLAMMemory, self)._push(*args, stream=stream)
+        self.records['frame_ids'][position] = self.frame_ids[position].numpy()
+
+    def flush(self):
+        """Writes the state to the header and flushes the file to disk."""
+        if self.mmap is None or self.read_only:
+            return
+        with self.lock:
+            self._write_header()
+            self.file_array.flush()
+
+    def _will_need(self, offsets, size):
+        if not hasattr(mmap, 'MADV_WILLNEED'):
+            return
+        page = mmap.PAGESIZE
+        for offset in np.sort(offsets):
+            start = int(offset) // page * page
+            self.mmap.madvise(mmap.MADV_WILLNEED, start,
+                              int(offset) + size - start)
+
+    def _get_valid(self):
+        # Also skips the records written after the last flush and the
+        # transitions whose frames they overwrote
+        frame_ids = self.frame_ids[:self.size].numpy()
+        return super(MemmapSLAMMemory, self)._get_valid() & \
+            (frame_ids[:, 0] >= self.min_frame_id) & \
+            (frame_ids[:, 1] < self.next_frame_id)
+
+    def _sample_indices(self, batch_size):
+        indices = super(MemmapSLAMMemory, self)._sample_indices(batch_size)
+        self._readahead(indices)
+        return indices
+
+    def _readahead(self, indices):
+        # Request the pages of the sampled frames and records from disk
+        # before they are gathered
+        frame_slots = self.frame_ids[indices] % self.frame_capacity
+        self._will_need(self.frames_offset + frame_slots.view(-1).numpy() *
+                        self.frame_bytes, self.frame_bytes)
+        self._will_need(self.records_offset + indices.numpy() *
+                        self.record_size, self.record_size)
+
+
+class BatchPrefetcher(object):
+    """
+    Samples batches from a FIFOMemory on a background thread, so that
+    sampling and host-to-device copies overlap with training.
+
+    request(n) asks for n batches, which are sampled ahead into a queue of
+    at most num_prefetch batches and returned in order by get(). On cuda
+    devices the copies run on a separate stream. wait_time accumulates the
+    time get() spent waiting for the worker.
+    """
+
+    def __init__(self, memory, batch_size, num_prefetch, device):
+        self.memory = memory
+        self.batch_size = batch_size
+        self.device = device
+        self.batches = queue.Queue(maxsize=num_prefetch)
+        self.requests = queue.Queue()
+        self.stream = None
+        if torch.device(device).type == 'cuda':
+            self.stream = torch.cuda.Stream(device)
+
+        self.wait_time = 0.
+        self.num_batches = 0
+
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _sample(self):
+        if self.stream is None:
+            return self.memory.sample(self.batch_size, self.device), None
+        with torch.cuda.stream(self.stream):
+            batch = self.memory.sample(self.batch_size, self.device)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        return batch, event
+
+    def _worker(self):
+        while True:
+            num_batches = self.requests.get()
+            if num_batches is None:
+                return
+            for _ in range(num_batches):
+                try:
+                    item = self._sample()
+                except Exception as e:
+                    item = (e, None)
+                self.batches.put(item)
+
+    def request(self, num_batches):
+        """Asks the worker to sample num_batches more batches."""
+        self.requests.put(num_batches)
+
+    def get(self):
+        """Returns the next requested batch, blocking until it is ready."""
+        start = time.time()
+        batch, event = self.batches.get()
+        self.wait_time += time.time() - start
+        self.num_batches += 1
+        if isinstance(batch, Exception):
+            raise batch
+
+        if event is not None:
+            # Wait for the copies on the prefetch stream, and let the
+            # caching allocator know the tensors are used on this stream
+            current = torch.cuda.current_stream(self.device)
+            current.wait_event(event)
+            for tensor in batch[0] + batch[1]:
+                tensor.record_stream(current)
+        return batch
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
@@ -0,0 +1,155 @@
+import argparse
+import threading
+
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+from utils.map_manager import MapManager
+
+
+def _make_manager(device='cpu', num_scenes=3):
+    args = argparse.Namespace(map_size_cm=1200, map_resolution=5,
+                              global_downscaling=2)
+    return MapManager(args, num_scenes, torch.device(device))
+
+
+def _fill_random(manager, seed=0):
+    torch.manual_seed(seed)
+    manager.local_map.copy_((torch.rand(manager.local_map.shape) > 0.7)
+                            .float())
+
+
+def _get_local_map_boundaries(cell, local_size, full_size):
+    # Per-env version MapManager.get_local_map_boundaries was batched from
+    gx1, gy1 = cell[0] - local_size // 2, cell[1] - local_size // 2
+    gx1 = min(max(gx1, 0), full_size - local_size)
+    gy1 = min(max(gy1, 0), full_size - local_size)
+    return [gx1, gx1 + local_size, gy1, gy1 + local_size]
+
+
+def _random_local_poses(manager, local_pose):
+    size = manager.local_w * manager.map_resolution / 100.
+    local_pose = local_pose + torch.randn(local_pose.shape) * \
+        torch.tensor([0.6, 0.6, 30.])
+    local_pose[:, :2] = local_pose[:, :2].clamp(0.15, size - 0.15)
+    return local_pose
+
+
+def test_update_global_matches_per_env_loop():
+    manager = _make_manager(num_scenes=4)
+    local_pose = manager.reset()
+    full_map = manager.full_map.clone()
+    lmb = manager.lmb_cpu.copy()
+    origins = manager.origins_cpu.copy()
+    torch.manual_seed(0)
+    for _ in range(10):
+        noise = (torch.rand(manager.local_map[:, :2].shape) < 0.05).float()
+        manager.local_map[:, :2] = torch.max(manager.local_map[:, :2], noise)
+        local_pose = _random_local_poses(manager, local_pose)
+        manager.stamp_location(local_pose, 2)
+        local_map = manager.local_map.clone()
+
+        new_local_pose = manager.update_global(local_pose)
+
+        # Write back, merge the team maps and read the new windows per env
+        for e in range(manager.num_scenes):
+            full_map[e, :4, lmb[e, 0]:lmb[e, 1], lmb[e, 2]:lmb[e, 3]] = \
+                local_map[e]
+            full_pose = local_pose[e] + torch.from_numpy(origins[e]).float()
+            cell = [int(full_pose[1].item() * 100. / manager.map_resolution),
+                    int(full_pose[0].item() * 100. / manager.map_resolution)]
+            lmb[e] = _get_local_map_boundaries(cell, manager.local_w,
+                                               manager.full_w)
+            origins[e] = [lmb[e, 2] * manager.map_resolution / 100.,
+                          lmb[e, 0] * manager.map_resolution / 100., 0.]
+            assert torch.equal(
+                new_local_pose[e],
+                full_pose - torch.from_numpy(origins[e]).float())
+        full_map[:, 0] = full_map[:, 0].max(0).values
+        full_map[:, 1] = full_map[:, 1].max(0).values
+        full_map[:, 4] = full_map[:, 2].max(0).values
+        local_pose = new_local_pose
+
+        assert np.array_equal(manager.lmb_cpu, lmb)
+        assert torch.equal(manager.full_map, full_map)
+        for e in range(manager.num_scenes):
+            assert torch.equal(manager.local_map[e], full_map[
+                e, :4, lmb[e, 0]:lmb[e, 1], lmb[e, 2]:lmb[e, 3]])
+
+
+def test_window_index_matches_slices():
+    # The window index is used on the GPU, per-env slices on the CPU
+    manager = _make_manager(num_scenes=3)
+    manager.reset()
+    torch.manual_seed(0)
+    manager.full_map.uniform_()
+    cells = torch.randint(0, manager.full_w, (3, 2))
+    manager._set_boundaries(manager.get_local_map_boundaries(cells))
+
+    index = manager._get_window_index()
+    manager._read_windows()
+    assert torch.equal(manager.full_map[index], manager.local_map)
+
+    manager.local_map.uniform_()
+    expected = manager.full_map.clone()
+    expected.index_put_(index, manager.local_map)
+    manager._write_windows()
+    assert torch.equal(manager.full_map, expected)
+
+
+def test_stamp_location_matches_slices():
+    manager = _make_manager(num_scenes=3)
+    manager.reset()
+    torch.manual_seed(0)
+    manager.local_map.copy_((torch.rand(manager.local_map.shape) > 0.9)
+                            .float())
+    expected = manager.local_map.clone()
+    local_pose = _random_local_poses(manager, torch.zeros(3, 3))
+
+    manager.stamp_location(local_pose, 2)
+    expected[:, 2] = 0.
+    for e, (r, c) in enumerate(manager.get_cells(local_pose).tolist()):
+        expected[e, 2:, max(r - 2, 0):r + 3, max(c - 2, 0):c + 3] = 1.
+    assert torch.equal(manager.local_map, expected)
+
+
+def test_pooled_map_matches_full_pooling():
+    manager = _make_manager(num_scenes=4)
+    local_pose = manager.reset()
+    gd = manager.global_downscaling
+    assert torch.equal(manager.pooled_map, F.max_pool2d(manager.full_map, gd))
+    torch.manual_seed(0)
+    for _ in range(10):
+        noise = (torch.rand(manager.local_map[:, :2].shape) < 0.05).float()
+        manager.local_map[:, :2] = torch.max(manager.local_map[:, :2], noise)
+        local_pose = _random_local_poses(manager, local_pose)
+        manager.stamp_location(local_pose, 2)
+        local_pose = manager.update_global(local_pose)
+        assert torch.equal(manager.pooled_map,
+                           F.max_pool2d(manager.full_map, gd))
+
+
+def test_planner_maps_cpu():
+    manager = _make_manager()
+    manager.reset()
+    _fill_random(manager)
+    maps = manager.get_planner_maps()
+    manager.wait_planner_maps()
+    assert np.array_equal(maps, manager.local_map[:, :2].numpy())
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="requires cuda")
+def test_planner_maps_cuda():
+    manager = _make_manager('cuda')
+    manager.reset()
+    for seed in range(3):
+        _fill_random(manager, seed)
+        expected = manager.local_map[:, :2].cpu().numpy()
+        maps = manager.get_planner_maps()
+        # Waited on from another thread, as the async planner does
+        thread = threading.Thread(target=manager.wait_planner_maps)
+        thread.start()
+        thread.join()
+        assert np.array_equal(maps, expected)
@@ -0,0 +1,31 @@
+import torch
+
+from utils.rewards import calc_rewards
+
+
+def _calc_rewards_loop(current_explored_area, previously_explored_area):
+    # Per-agent loop calc_rewards was vectorized from
+    new_explored_area = torch.zeros_like(current_explored_area)
+    for a_ix, a in enumerate(current_explored_area):
+        z = ((torch.sum(current_explored_area, dim=0) - a) > 0.5).float()
+        new_explored_area[a_ix] = ((a - z - previously_explored_area.float())
+                                   > 0).float() * 10 + a * 0.01
+    return new_explored_area.sum(
+        dim=tuple(range(1, new_explored_area.dim()))) * 0.0005
+
+
+def test_calc_rewards_matches_loop():
+    torch.manual_seed(0)
+    for num_agents in [1, 2, 4]:
+        previous = (torch.rand(60, 60) > 0.6).float()
+        current = torch.max((torch.rand(num_agents, 60, 60) > 0.5).float(),
+                            previous * (torch.rand(num_agents, 1, 1) > 0.5))
+        expected = _calc_rewards_loop(current, previous)
+
+        assert torch.allclose(calc_rewards(current, previous), expected)
+
+        # Only the cells newly explored by the team can be new
+        team = torch.max(current, dim=0).values
+        changed_cells = torch.nonzero((team > previous).view(-1)).squeeze(1)
+        assert torch.allclose(calc_rewards(current, previous, changed_cells),
+                              expected)
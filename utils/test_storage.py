@@ -0,0 +1,185 @@
+import argparse
+import json
+
+import numpy as np
+import pytest
+import torch
+
+from utils.storage import CompactSLAMMemory, FIFOMemory, MemmapSLAMMemory, \
+    RolloutStorage, pack_bits, unpack_bits
+
+
+def _make_datapoints(num_steps, num_streams=2, seed=0):
+    # Consecutive datapoints of a stream share their frames, like the
+    # datapoints pushed by main.py
+    rng = torch.Generator().manual_seed(seed)
+
+    def frame():
+        return torch.randint(0, 256, (3, 8, 8), generator=rng).float()
+
+    def proj():
+        return (torch.rand(1, 10, 10, generator=rng) > 0.5).float()
+
+    obs = [frame() for _ in range(num_streams)]
+    datapoints = []
+    for _ in range(num_steps):
+        for e in range(num_streams):
+            last_obs, obs[e] = obs[e], frame()
+            datapoints.append((e, (last_obs, obs[e],
+                                   torch.rand(3, generator=rng)),
+                               (proj(), proj(),
+                                torch.rand(3, generator=rng))))
+    return datapoints
+
+
+def _push(memory, datapoints):
+    for stream, x, y in datapoints:
+        memory.push(x, y, stream=stream)
+
+
+def _sample(memory, batch_size, seed=1):
+    np.random.seed(seed)
+    inputs, outputs = memory.sample(batch_size)
+    return inputs + outputs
+
+
+def test_pack_bits_roundtrip():
+    x = (torch.rand(5, 1, 7, 9) > 0.5).float()
+    packed = pack_bits(x)
+    assert packed.dtype == torch.uint8
+    assert packed.shape == (5, (7 * 9 + 7) // 8)
+    assert torch.equal(unpack_bits(packed, (1, 7, 9)), x)
+
+
+def test_compact_memory_matches_fifo_memory():
+    datapoints = _make_datapoints(20)
+    fifo = FIFOMemory(16)
+    compact = CompactSLAMMemory(16)
+    _push(fifo, datapoints)
+    _push(compact, datapoints)
+    # Shared frames are stored once
+    assert compact.next_frame_id < 2 * len(datapoints)
+    for x, y in zip(_sample(fifo, 10), _sample(compact, 10)):
+        assert torch.equal(x, y)
+
+
+def _push_from(memory, datapoints, last_device, last_dtype):
+    for stream, x, y in datapoints:
+        memory.push((x[0].to(last_device, last_dtype), x[1], x[2]), y,
+                    stream=stream)
+
+
+def test_compact_memory_frames_from_other_dtype():
+    datapoints = _make_datapoints(10)
+    compact = CompactSLAMMemory(32)
+    reference = CompactSLAMMemory(32)
+    _push_from(compact, datapoints, 'cpu', torch.float64)
+    _push(reference, datapoints)
+    assert compact.next_frame_id == reference.next_frame_id
+    for x, y in zip(_sample(reference, 10), _sample(compact, 10)):
+        assert torch.equal(x, y)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="requires cuda")
+def test_compact_memory_frames_from_cuda():
+    # main.py pushes obs_last from the device and obs from the host
+    datapoints = _make_datapoints(10)
+    compact = CompactSLAMMemory(32)
+    reference = CompactSLAMMemory(32)
+    _push_from(compact, datapoints, 'cuda', torch.float32)
+    _push(reference, datapoints)
+    assert compact.next_frame_id == reference.next_frame_id
+    for x, y in zip(_sample(reference, 10), _sample(compact, 10)):
+        assert torch.equal(x, y)
+
+
+def test_compact_memory_skips_overwritten_frames():
+    # Without frame slack the oldest transitions lose their frames
+    compact = CompactSLAMMemory(16, frame_slack=0)
+    _push(compact, _make_datapoints(20))
+    valid = compact._get_valid()
+    assert 0 < valid.sum() < len(compact)
+
+    # Asking for more transitions than valid returns the valid ones
+    indices = compact._sample_indices(len(compact)).numpy()
+    assert len(indices) == valid.sum()
+    assert sorted(indices) == list(np.flatnonzero(valid))
+
+
+def test_memmap_memory_resumes_from_flush(tmp_path):
+    path = str(tmp_path / "replay.bin")
+    datapoints = _make_datapoints(20)
+    compact = CompactSLAMMemory(64)
+    memmap = MemmapSLAMMemory(64, path)
+    _push(compact, datapoints[:30])
+    _push(memmap, datapoints[:30])
+    memmap.flush()
+    # Pushed after the flush, lost on resume
+    _push(memmap, datapoints[30:])
+    del memmap
+
+    resumed = MemmapSLAMMemory(64, path)
+    assert len(resumed) == 30
+    for x, y in zip(_sample(compact, 20), _sample(resumed, 20)):
+        assert torch.equal(x, y)
+
+    reader = MemmapSLAMMemory(64, path, read_only=True)
+    _push(compact, datapoints[30:])
+    _push(resumed, datapoints[30:])
+    resumed.flush()
+    reader.refresh()
+    assert len(reader) == len(compact)
+    for x, y in zip(_sample(compact, 20), _sample(reader, 20)):
+        assert torch.equal(x, y)
+
+
+def test_memmap_memory_skips_records_after_flush(tmp_path):
+    # Records written after the flush overwrite old positions once the
+    # memory is full
+    path = str(tmp_path / "replay.bin")
+    datapoints = _make_datapoints(20)
+    memmap = MemmapSLAMMemory(16, path)
+    _push(memmap, datapoints[:20])
+    memmap.flush()
+    _push(memmap, datapoints[20:24])
+    del memmap
+
+    resumed = MemmapSLAMMemory(16, path, read_only=True)
+    frame_ids = resumed.frame_ids[resumed._sample_indices(16)].numpy()
+    assert len(frame_ids) <= 12
+    assert (frame_ids[:, 1] < resumed.next_frame_id).all()
+    assert (frame_ids[:, 0] >= resumed.min_frame_id).all()
+
+
+def test_memmap_memory_checks_version(tmp_path):
+    path = str(tmp_path / "replay.bin")
+    memmap = MemmapSLAMMemory(16, path)
+    _push(memmap, _make_datapoints(2))
+    memmap.flush()
+    header = memmap._read_header()
+    del memmap
+
+    header['version'] += 1
+    data = json.dumps(header).encode('utf-8')
+    with open(path, 'r+b') as f:
+        f.write(data + b' ' * (MemmapSLAMMemory.header_size - len(data)))
+    with pytest.raises(ValueError, match="version"):
+        MemmapSLAMMemory(16, path)
+
+
+@pytest.mark.parametrize("use_gae", [False, True])
+def test_vectorized_returns_match_loop(use_gae):
+    torch.manual_seed(0)
+    action_space = argparse.Namespace(shape=(2,))
+    rollouts = RolloutStorage(20, 8, (1,), action_space, 1, 'cpu')
+    rollouts.rewards.uniform_(-1., 1.)
+    rollouts.value_preds.uniform_(-5., 5.)
+    rollouts.masks.copy_((torch.rand_like(rollouts.masks) > 0.1).float())
+    next_value = torch.randn(8)
+
+    rollouts.compute_returns(next_value, use_gae, 0.99, 0.95)
+    returns_loop = rollouts.returns.clone()
+    rollouts.compute_returns(next_value, use_gae, 0.99, 0.95,
+                             vectorized=True)
+    assert torch.allclose(rollouts.returns, returns_loop, rtol=1e-5,
+                          atol=1e-5)